@@ -81,3 +81,24 @@ FOREIGN KEY (species_id) REFERENCES species (id),
 FOREIGN KEY (subject_id) REFERENCES subjects (id)
 );
 """
+
+# Secondary indexes for the lookups and joins done by the tutorials,
+# keyed by index name
+indexes = {
+    "idx_subjects_type_clips": "subjects (subject_type, movie_id, clip_start_time, clip_end_time)",
+    "idx_subjects_frame_exp_sp": "subjects (frame_exp_sp_id, subject_type, movie_id, frame_number)",
+    "idx_subjects_movie_frame": "subjects (movie_id, frame_number)",
+    "idx_subjects_filename": "subjects (filename)",
+    "idx_agg_annotations_clip_subject": "agg_annotations_clip (subject_id)",
+    "idx_agg_annotations_frame_subject": "agg_annotations_frame (subject_id)",
+}
+
+# Hot queries that should be answered through the indexes above
+index_queries = [
+    "SELECT id, movie_id, clip_start_time, clip_end_time FROM subjects WHERE subject_type='clip'",
+    "SELECT movie_id, frame_number, frame_exp_sp_id FROM subjects WHERE frame_exp_sp_id IN (1, 2) AND subject_type='frame'",
+    "SELECT id FROM subjects WHERE movie_id=1 AND frame_number=1",
+    "SELECT id, subject_type FROM subjects WHERE filename='movie.mov'",
+    "SELECT a.species_id, b.id FROM subjects AS b JOIN agg_annotations_clip AS a ON a.subject_id=b.id WHERE b.id=1",
+    "SELECT a.species_id, b.id FROM subjects AS b JOIN agg_annotations_frame AS a ON a.subject_id=b.id WHERE b.id=1",
+]
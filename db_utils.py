@@ -2,7 +2,10 @@
 import os
 import sqlite3
 import logging
+import threading
 import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
 
 # util imports
 import kso_utils.db_starter.schema as schema
@@ -15,17 +18,35 @@ import kso_utils.project_utils as project_utils
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
+# Pragmas applied to the pooled connections (see get_connection)
+pool_pragmas = {
+    "foreign_keys": 1,
+    "cache_size": -64000,
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+# Connections kept open for each thread, keyed by database path and access mode
+_pool = threading.local()
+
+# Journal mode of the databases before their bulk load, keyed by bulk-load connection
+_bulk_journal_modes = {}
+
 # Utility functions for common database operations
 
 
-def init_db(db_path: str):
+def init_db(db_path: str, incremental: bool = False):
     """Initiate a new database for the project
     :param db_path: path of the database file
+    :param incremental: keep the existing database (if any) so it can be synced incrementally
     """
 
-    # Delete previous database versions if exists
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # Delete previous database versions (and any leftover WAL files) if exists
+    if not incremental:
+        close_connections(db_path)
+        for db_file in [db_path, db_path + "-wal", db_path + "-shm"]:
+            if os.path.exists(db_file):
+                os.remove(db_file)
 
     # Get sql command for db setup
     sql_setup = schema.sql
@@ -36,6 +57,11 @@ def init_db(db_path: str):
     if conn is not None:
         # execute sql
         execute_sql(conn, sql_setup)
+
+        # create the secondary indexes and check the hot queries use them
+        create_indexes(conn)
+        check_query_plans(conn)
+        conn.close()
         return "Database creation success"
     else:
         return "Database creation failure"
@@ -58,6 +84,181 @@ def create_connection(db_file: str):
     return conn
 
 
+def create_indexes(conn: sqlite3.Connection):
+    """
+    Create the secondary indexes declared in schema.indexes
+    :param conn: the Connection object
+    """
+    for index_name, index_on in schema.indexes.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {index_on}")
+    conn.commit()
+
+
+def drop_indexes(conn: sqlite3.Connection):
+    """
+    Drop the secondary indexes declared in schema.indexes
+    :param conn: the Connection object
+    """
+    for index_name in schema.indexes:
+        conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+    conn.commit()
+
+
+def check_query_plans(conn: sqlite3.Connection):
+    """
+    > This function runs EXPLAIN QUERY PLAN on the hot queries listed in schema.index_queries
+    and warns about those that need a full table scan
+
+    :param conn: the Connection object
+    :return: a list of the queries that are not using an index
+    """
+    full_scans = []
+    for query in schema.index_queries:
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+        if any(step.startswith("SCAN") and "INDEX" not in step for step in plan):
+            logging.warning(f"The query '{query}' is not using an index: {plan}")
+            full_scans.append(query)
+
+    return full_scans
+
+
+def get_connection(db_path: str, read_only: bool = False, pragmas: dict = None):
+    """
+    > This function returns the connection to the database kept open for the current thread,
+    opening it the first time it is requested. The connections are not shared across threads
+    and stay open until close_connections is called
+
+    :param db_path: path of the database file
+    :param read_only: open the database in read-only mode, for analytics queries
+    :param pragmas: pragmas to apply on top of pool_pragmas, e.g. {"cache_size": -200000}
+    :return: Connection object or None
+    """
+    if not hasattr(_pool, "connections"):
+        _pool.connections = {}
+
+    key = (os.path.abspath(db_path), read_only)
+    conn = _pool.connections.get(key)
+
+    if conn is None or pragmas is not None:
+        try:
+            if conn is None:
+                if read_only:
+                    conn = sqlite3.connect(Path(key[0]).as_uri() + "?mode=ro", uri=True)
+                else:
+                    conn = sqlite3.connect(key[0])
+                _pool.connections[key] = conn
+
+            for pragma, value in {**pool_pragmas, **(pragmas or {})}.items():
+                conn.execute(f"PRAGMA {pragma} = {value}")
+        except sqlite3.Error as e:
+            logging.error(e)
+
+    return conn
+
+
+@contextmanager
+def connection(db_path: str, read_only: bool = False, pragmas: dict = None):
+    """
+    > This function yields the pooled connection of the current thread (see get_connection),
+    committing the changes made through it on exit or rolling them back if an error is raised
+
+    :param db_path: path of the database file
+    :param read_only: open the database in read-only mode, for analytics queries
+    :param pragmas: pragmas to apply on top of pool_pragmas
+    """
+    conn = get_connection(db_path, read_only, pragmas)
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def close_connections(db_path: str = None):
+    """
+    Close the pooled connections of the current thread
+    :param db_path: only close the connections to this database, defaults to all of them
+    """
+    connections = getattr(_pool, "connections", {})
+
+    for key in list(connections):
+        if db_path is None or key[0] == os.path.abspath(db_path):
+            connections.pop(key).close()
+
+
+def begin_bulk_load(db_path: str, defer_indexes: bool = True):
+    """
+    > This function opens a connection tuned for loading many rows at once. The journal is
+    switched to WAL, synchronous writes are turned off and foreign key checks are deferred
+    until end_bulk_load, so all the inserts done through it share a single transaction.
+    Always call end_bulk_load on it, also when the load fails, to restore the database
+
+    :param db_path: path of the database file
+    :param defer_indexes: drop the secondary indexes during the load and build them in
+    end_bulk_load, worth it unless only a few rows are added to a large database
+    :return: Connection object or None
+    """
+    # Close the pooled connections to the database, so the journal mode can be switched
+    close_connections(db_path)
+
+    conn = create_connection(db_path)
+
+    if conn is not None:
+        if defer_indexes:
+            drop_indexes(conn)
+
+        # Pragmas must be set before the transaction starts
+        _bulk_journal_modes[conn] = (
+            db_path,
+            conn.execute("PRAGMA journal_mode").fetchone()[0],
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA foreign_keys = 0")
+
+    return conn
+
+
+def end_bulk_load(conn: sqlite3.Connection):
+    """
+    > This function checks the foreign keys that were deferred during the load and commits the
+    transaction of a bulk-load connection, rolling it back if any row has an invalid foreign key.
+    Then it restores the pragmas and journal mode of the database, builds the deferred indexes
+    and closes the connection, whether the load is committed or not
+
+    :param conn: the Connection object returned by begin_bulk_load
+    """
+    try:
+        if conn.in_transaction:
+            # Check the foreign keys skipped during the load
+            violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+            if violations:
+                conn.rollback()
+                raise sqlite3.IntegrityError(
+                    f"The bulk load left {len(violations)} rows with invalid foreign keys, "
+                    f"the first ones are {violations[:5]}. The load was rolled back"
+                )
+            conn.commit()
+    finally:
+        # Restore the default pragmas and the previous journal mode
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("PRAGMA foreign_keys = 1")
+        db_path, journal_mode = _bulk_journal_modes.pop(conn, (None, "delete"))
+        if db_path is not None:
+            # Pooled connections opened during the load would lock the database
+            close_connections(db_path)
+        try:
+            conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        except sqlite3.Error as e:
+            logging.warning(f"Unable to restore the journal mode {journal_mode}, {e}")
+
+        # Build the secondary indexes deferred during the load
+        create_indexes(conn)
+        conn.close()
+
+
 def insert_many(conn: sqlite3.Connection, data: list, table: str, count: int):
     """
     Insert multiple rows into table
@@ -75,6 +276,50 @@ def insert_many(conn: sqlite3.Connection, data: list, table: str, count: int):
     cur.executemany(f"INSERT INTO {table} VALUES {values}", data)
 
 
+def get_unique_constraints(conn: sqlite3.Connection, table: str):
+    """
+    Get the fields of the UNIQUE constraints of a table (e.g. siteName in sites)
+    :param conn: the Connection object
+    :param table: table of interest
+    :return: a list with the tuple of fields of each UNIQUE constraint
+    """
+    return [
+        tuple(i[2] for i in conn.execute(f"PRAGMA index_info({index[1]})"))
+        for index in conn.execute(f"PRAGMA index_list({table})")
+        if index[3] == "u"
+    ]
+
+
+def upsert_many(conn: sqlite3.Connection, data: list, table: str, key: str = "id"):
+    """
+    Insert multiple rows into table, updating the rows whose key already exists. Rows whose
+    natural key (a UNIQUE constraint of the table, e.g. siteName in sites) exists under a different
+    key update that row, taking the new key
+    :param conn: the Connection object
+    :param data: data to be inserted into table, with values for all the fields
+    :param table: table of interest
+    :param key: the primary key used to detect existing rows
+    :return:
+    """
+
+    # Get the names of the fields in the table
+    field_names = [i[1] for i in conn.execute(f"PRAGMA table_info({table})")]
+
+    values = ", ".join(["?"] * len(field_names))
+    updates = ", ".join([f"{f} = excluded.{f}" for f in field_names if f != key])
+    all_updates = ", ".join([f"{f} = excluded.{f}" for f in field_names])
+
+    # Add an upsert clause for each UNIQUE constraint of the table
+    conflicts = f"ON CONFLICT({key}) DO UPDATE SET {updates}"
+    for unique_fields in get_unique_constraints(conn, table):
+        conflicts += (
+            f" ON CONFLICT({', '.join(unique_fields)}) DO UPDATE SET {all_updates}"
+        )
+
+    cur = conn.cursor()
+    cur.executemany(f"INSERT INTO {table} VALUES ({values}) {conflicts}", data)
+
+
 def retrieve_query(conn: sqlite3.Connection, query: str):
     """
     Execute SQL query and returns output
@@ -106,21 +351,43 @@ def execute_sql(conn: sqlite3.Connection, sql: str):
         logging.error(e)
 
 
-def add_to_table(db_path: str, table_name: str, values: list, num_fields: int):
-
-    conn = create_connection(db_path)
-
-    try:
-        insert_many(
-            conn,
-            values,
-            table_name,
-            num_fields,
-        )
-    except sqlite3.Error as e:
-        logging.error(e)
+def add_to_table(
+    db_path: str,
+    table_name: str,
+    values: list,
+    num_fields: int,
+    conn: sqlite3.Connection = None,
+    upsert: bool = False,
+):
+    """
+    Insert the values into the table of interest
+    :param db_path: path of the database file
+    :param table_name: table of interest
+    :param values: list of tuples to be inserted into table
+    :param num_fields: number of fields
+    :param conn: an open bulk-load connection, if given the values are added to its
+    transaction and committed by end_bulk_load, and errors are raised so the load is rolled back
+    :param upsert: update the rows whose id is already in the table instead of failing
+    """
 
-    conn.commit()
+    # Use the pooled connection (committed on exit) unless a bulk-load connection is given
+    bulk_load = conn is not None
+    with nullcontext(conn) if bulk_load else connection(db_path) as conn:
+        try:
+            if upsert:
+                upsert_many(conn, values, table_name)
+            else:
+                insert_many(
+                    conn,
+                    values,
+                    table_name,
+                    num_fields,
+                )
+        except sqlite3.Error as e:
+            logging.error(e)
+            # Let the bulk load roll back the whole transaction
+            if bulk_load:
+                raise
 
     logging.info(f"Updated {table_name}")
 
@@ -171,7 +438,7 @@ def get_column_names_db(db_info_dict: pd.DataFrame, table_i: str):
     :return: A list of column names of the table of interest
     """
     # Connect to the db
-    conn = create_connection(db_info_dict["db_path"])
+    conn = get_connection(db_info_dict["db_path"], read_only=True)
 
     # Get the data of the table of interest
     data = conn.execute(f"SELECT * FROM {table_i}")
@@ -183,7 +450,10 @@ def get_column_names_db(db_info_dict: pd.DataFrame, table_i: str):
 
 
 def process_test_csv(
-    db_info_dict: dict, project: project_utils.Project, local_csv: str
+    db_info_dict: dict,
+    project: project_utils.Project,
+    local_csv: str,
+    conn: sqlite3.Connection = None,
 ):
     """
     > This function process a csv of interest and tests for compatibility with the respective sql table of interest
@@ -191,6 +461,7 @@ def process_test_csv(
     :param db_info_dict: The dictionary containing the database information
     :param project: The project object
     :param local_csv: a string of the names of the local csv to populate from
+    :param conn: an open bulk-load connection, used to read rows not committed yet
     :return a string of the category of interest and the processed dataframe
     """
     # Load the csv with the information of interest
@@ -201,7 +472,7 @@ def process_test_csv(
         field_names, csv_i, df = process_sites_df(db_info_dict, df, project)
 
     if "movies" in local_csv:
-        field_names, csv_i, df = process_movies_df(db_info_dict, df, project)
+        field_names, csv_i, df = process_movies_df(db_info_dict, df, project, conn)
 
     if "species" in local_csv:
         field_names, csv_i, df = process_species_df(db_info_dict, df, project)
@@ -223,18 +494,27 @@ def process_test_csv(
     return csv_i, df
 
 
-def populate_db(db_initial_info: dict, project: project_utils.Project, local_csv: str):
+def populate_db(
+    db_initial_info: dict,
+    project: project_utils.Project,
+    local_csv: str,
+    conn: sqlite3.Connection = None,
+    upsert: bool = False,
+):
     """
     > This function populates a sql table of interest based on the info from the respective csv
 
     :param db_initial_info: The dictionary containing the initial database information
     :param project: The project object
     :param local_csv: a string of the names of the local csv to populate from
+    :param conn: an open bulk-load connection (see begin_bulk_load), defaults to a new
+    connection committed straight away
+    :param upsert: update the rows already in the table instead of failing
     """
 
     # Process the csv of interest and tests for compatibility with sql table
     csv_i, df = process_test_csv(
-        db_info_dict=db_initial_info, project=project, local_csv=local_csv
+        db_info_dict=db_initial_info, project=project, local_csv=local_csv, conn=conn
     )
 
     # Add values of the processed csv to the sql table of interest
@@ -243,6 +523,8 @@ def populate_db(db_initial_info: dict, project: project_utils.Project, local_csv
         csv_i,
         [tuple(i) for i in df.values],
         len(df.columns),
+        conn=conn,
+        upsert=upsert,
     )
 
 
@@ -273,7 +555,10 @@ def process_sites_df(
 
 
 def process_movies_df(
-    db_info_dict: dict, df: pd.DataFrame, project: project_utils.Project
+    db_info_dict: dict,
+    df: pd.DataFrame,
+    project: project_utils.Project,
+    conn: sqlite3.Connection = None,
 ):
     """
     > This function processes the movies dataframe and returns a string with the category of interest
@@ -281,6 +566,7 @@ def process_movies_df(
     :param db_info_dict: The dictionary containing the database information
     :param df: a pandas dataframe of the information of interest
     :param project: The project object
+    :param conn: an open bulk-load connection, used to read sites not committed yet
     :return: a string of the category of interest and the processed dataframe
     """
 
@@ -293,7 +579,8 @@ def process_movies_df(
         df = koster_utils.process_koster_movies_csv(df)
 
     # Connect to database
-    conn = create_connection(db_info_dict["db_path"])
+    if conn is None:
+        conn = get_connection(db_info_dict["db_path"])
 
     # Reference movies with their respective sites
     sites_df = pd.read_sql_query("SELECT id, siteName FROM sites", conn)
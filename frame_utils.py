@@ -2,28 +2,33 @@
 import os
 import logging
 import argparse
-import pims
 import db_utils
 import cv2 as cv
 import pandas as pd
 from tqdm import tqdm
 
+# util imports
+import kso_utils.movie_utils as movie_utils
+
 # Logging
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
 
-def drawBoxes(df: pd.DataFrame, movie_dir: str, out_path: str):
+def drawBoxes(
+    df: pd.DataFrame, movie_dir: str, out_path: str, max_open_movies: int = 4
+):
     """
-    For each unique movie, create a dictionary of movie paths and their corresponding pims.Video
-    objects. Then, for each unique movie, frame number, species id, and filename, get the corresponding
-    frame, get the bounding boxes for that frame, and draw the bounding boxes on the frame. Then, write
-    the frame to the output directory
+    For each unique movie, frame number, species id, and filename, get the corresponding frame, get the
+    bounding boxes for that frame, and draw the bounding boxes on the frame. Then, write the frame to the
+    output directory. The frames are read in (movie, frame) order from a pool of pims.Video readers, so
+    only max_open_movies movies are open at the same time
 
     :param df: the dataframe containing the bounding box coordinates
     :param movie_dir: The directory where the movies are stored
     :param out_path: The path to the directory where you want to save the images with the bounding boxes
     drawn on them
+    :param max_open_movies: the maximum number of movies open at the same time, defaults to 4
     """
     df["movie_path"] = (
         movie_dir
@@ -32,24 +37,25 @@ def drawBoxes(df: pd.DataFrame, movie_dir: str, out_path: str):
             lambda x: os.path.basename(x.rsplit("_frame_")[0]) + ".mov"
         )
     )
-    movie_dict = {i: pims.Video(i) for i in df["movie_path"].unique()}
     df["annotation"] = df[["x_position", "y_position", "width", "height"]].apply(
         lambda x: tuple([x[0], x[1], x[2], x[3]]), 1
     )
     df = df.drop(columns=["x_position", "y_position", "width", "height"])
-    for name, group in tqdm(
-        df.groupby(["movie_path", "frame_number", "species_id", "filename"])
-    ):
-        frame = movie_dict[name[0]][name[1]]
-        boxes = [tuple(i[4:])[0] for i in group.values]
-        for box in boxes:
-            # Calculating end-point of bounding box based on starting point and w, h
-            end_box = tuple([int(box[0] + box[2]), int(box[1] + box[3])])
-            # changed color and width to make it visible
-            cv.rectangle(frame, (int(box[0]), int(box[1])), end_box, (255, 0, 0), 1)
-        if not os.path.exists(out_path):
-            os.mkdir(out_path)
-        cv.imwrite(out_path + "/" + os.path.basename(name[3]), frame)
+    # The groups are sorted by movie and frame
+    with movie_utils.MovieReaderPool(max_open_movies) as readers:
+        for name, group in tqdm(
+            df.groupby(["movie_path", "frame_number", "species_id", "filename"])
+        ):
+            frame = readers.get(name[0])[name[1]]
+            boxes = [tuple(i[4:])[0] for i in group.values]
+            for box in boxes:
+                # Calculating end-point of bounding box based on starting point and w, h
+                end_box = tuple([int(box[0] + box[2]), int(box[1] + box[3])])
+                # changed color and width to make it visible
+                cv.rectangle(frame, (int(box[0]), int(box[1])), end_box, (255, 0, 0), 1)
+            if not os.path.exists(out_path):
+                os.mkdir(out_path)
+            cv.imwrite(out_path + "/" + os.path.basename(name[3]), frame)
 
 
 def main():
@@ -107,7 +107,7 @@ def manual_subjects(subjects_df: pd.DataFrame, manual_date: str, auto_date: str)
 def get_movies_id(df: pd.DataFrame, db_path: str):
 
     # Create connection to db
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     # Query id and filenames from the movies table
     movies_df = pd.read_sql_query("SELECT id, filename FROM movies", conn)
@@ -415,6 +415,38 @@ def bb_iou(boxA, boxB):
     return 1 - iou
 
 
+def bb_iou_matrix(bboxes: list):
+    """
+    The function computes the IoU distance (1 - IoU, see bb_iou) between all the pairs of bounding
+    boxes at once, so it can be passed to DBSCAN as a precomputed metric
+
+    :param bboxes: list of bounding boxes as [x, y, w, h]
+    :return: A square matrix with the IoU distances
+    """
+
+    # Compute edges
+    boxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+
+    # determine the width and height of the intersection rectangles
+    inter_w = np.maximum(
+        np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]), 0
+    )
+    inter_h = np.maximum(
+        np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]), 0
+    )
+
+    # compute the area of the intersection and both boxes
+    inter_area = np.abs(inter_w * inter_h)
+    box_area = np.abs(boxes[:, 2] * boxes[:, 3])
+    union_area = box_area[:, None] + box_area[None, :] - inter_area
+
+    # boxes that do not intersect are at the maximum distance
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(inter_area == 0, 1.0, 1 - inter_area / union_area)
+
+
 def filter_bboxes(
     total_users: int, users: list, bboxes: list, obj: float, eps: float, iua: float
 ):
@@ -437,7 +469,9 @@ def filter_bboxes(
     user_count = pd.Series(users).nunique()
     if user_count / total_users >= obj:
         # Get clusters of annotation boxes based on iou criterion
-        cluster_ids = DBSCAN(min_samples=1, metric=bb_iou, eps=eps).fit_predict(bboxes)
+        cluster_ids = DBSCAN(min_samples=1, metric="precomputed", eps=eps).fit_predict(
+            bb_iou_matrix(bboxes)
+        )
         # Count the number of users within each cluster
         counter_dict = Counter(cluster_ids)
         # Accept a cluster assignment if at least 80% of users agree on annotation
@@ -2,12 +2,26 @@
 from lib2to3.pytree import convert
 import os
 import cv2
+import json
+import time
+import bisect
+import struct
+import hashlib
+import shutil
+import sqlite3
+import threading
+import pims
 import pandas as pd
 from tqdm import tqdm
 import difflib
 import logging
 import subprocess
 import urllib
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from collections.abc import Callable
+from multiprocessing.pool import ThreadPool as Pool
 
 # util imports
 import kso_utils.server_utils as server_utils
@@ -19,28 +33,605 @@ import kso_utils.tutorials_utils as tutorials_utils
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
+# Times of the keyframes of the movies already probed, keyed by the validators of the movie
+# (see get_movie_validators) so a movie replaced at the same path is probed again
+keyframes_cache = OrderedDict()
+keyframes_cache_size = 64
+keyframes_lock = threading.Lock()
 
-def get_fps_duration(movie_path: str):
+# Name of the sqlite file, next to the project db, caching the metadata of the movies
+movies_metadata_db = "movies_metadata.db"
+
+
+def get_fps_duration(movie_path: str, db_path: str = None):
     '''
     This function takes the path (or url) of a movie and returns its fps and duration information
 
     :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param db_path: the path to the project db, to read/store the metadata in the movies metadata cache next to it
     :return: Two integers, the fps and duration of the movie
     """
     '''
-    cap = cv2.VideoCapture(movie_path)
+    movie_metadata = get_movie_metadata(movie_path, db_path)
+
+    return movie_metadata["fps"], movie_metadata["duration"]
+
+
+def get_movies_fps_duration(
+    movie_paths: list, db_path: str = None, pool_size: int = 8, timeout: int = 60
+):
+    """
+    This function gets the fps and duration of several movies at the same time. Reaching each movie is
+    mostly waiting on the network, so they are probed by a pool of threads. The movies that can't be probed
+    (missing, unreachable or slower than the timeout) are reported and don't stop the others
+
+    :param movie_paths: a list with the paths (or urls) where the movies of interest can be access from
+    :param db_path: the path to the project db, to read/store the metadata in the movies metadata cache next to it
+    :param pool_size: the max number of movies probed at the same time, defaults to 8
+    :param timeout: the number of seconds after which reaching a movie is given up, defaults to 60
+    :return: a list with the fps and duration of each movie, (None, None) for the movies that couldn't be probed
+    """
+
+    def probe_fps_duration(movie_path):
+        try:
+            movie_metadata = get_movie_metadata(movie_path, db_path, timeout=timeout)
+            return movie_metadata["fps"], movie_metadata["duration"], None
+        except Exception as e:
+            return None, None, e
+
+    fps_duration = []
+    failed_movies = {}
+    with Pool(pool_size) as pool:
+        for movie_path, (fps, duration, error) in zip(
+            movie_paths,
+            tqdm(
+                pool.imap(probe_fps_duration, movie_paths),
+                total=len(movie_paths),
+            ),
+        ):
+            fps_duration.append((fps, duration))
+            if error is not None:
+                failed_movies[movie_path] = error
+
+    if failed_movies:
+        logging.error(
+            f"The fps and duration of {len(failed_movies)} out of {len(movie_paths)} movies couldn't be retrieved:"
+        )
+        for movie_path, error in failed_movies.items():
+            logging.error(f"{movie_path}: {error}")
+
+    return fps_duration
+
+
+def probe_movie_metadata(movie_path: str, timeout: int = None):
+    """
+    This function opens a movie with opencv and returns its fps, frame count, duration, codec and resolution
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param timeout: the number of seconds after which opening/reading the movie is given up, defaults to opencv's default
+    :return: a dictionary with the metadata of the movie
+    """
+    if timeout is None:
+        cap = cv2.VideoCapture(movie_path)
+    else:
+        cap = cv2.VideoCapture(
+            movie_path,
+            cv2.CAP_FFMPEG,
+            [
+                cv2.CAP_PROP_OPEN_TIMEOUT_MSEC,
+                int(timeout * 1000),
+                cv2.CAP_PROP_READ_TIMEOUT_MSEC,
+                int(timeout * 1000),
+            ],
+        )
     fps = cap.get(cv2.CAP_PROP_FPS)
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    
+
     # Roadblock to prevent issues with missing movies
-    if int(frame_count)|int(fps) == 0:
+    if frame_count <= 0 or fps <= 0:
+        cap.release()
         raise ValueError(
             f"{movie_path} doesn't have any frames, check the path/link is correct."
         )
+
+    h = int(cap.get(cv2.CAP_PROP_FOURCC))
+    codec = (
+        chr(h & 0xFF)
+        + chr((h >> 8) & 0xFF)
+        + chr((h >> 16) & 0xFF)
+        + chr((h >> 24) & 0xFF)
+    )
+
+    movie_metadata = {
+        "fps": fps,
+        "frame_count": frame_count,
+        "duration": frame_count / fps,
+        "codec": codec,
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+    }
+    cap.release()
+
+    return movie_metadata
+
+
+def get_movie_validators(movie_path: str, timeout: int = 30):
+    """
+    This function returns the key and validators used to check the cached metadata of a movie is up to date.
+    Local movies are validated by size and modification time, and urls by ETag and size. The query of the
+    urls (e.g. the signature of presigned urls) is not part of the key, so it doesn't change between runs
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param timeout: the number of seconds to wait for the response of urls, defaults to 30
+    :return: A tuple with the key, ETag, size and modification time of the movie (None if unknown)
+    """
+    if os.path.exists(movie_path):
+        movie_stat = os.stat(movie_path)
+        return os.path.abspath(movie_path), None, movie_stat.st_size, movie_stat.st_mtime
+
+    if tutorials_utils.is_url(movie_path):
+        url = urllib.parse.urlsplit(movie_path)
+        movie_key = f"{url.scheme}://{url.netloc}{url.path}"
+
+        # Request a single byte, as presigned urls don't accept HEAD requests
+        try:
+            request = urllib.request.Request(movie_path, headers={"Range": "bytes=0-0"})
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                etag = response.headers.get("ETag")
+                content_range = response.headers.get("Content-Range", "")
+                if "/" in content_range and not content_range.endswith("*"):
+                    size = int(content_range.rsplit("/", 1)[1])
+                else:
+                    size = response.length
+        except (OSError, ValueError) as e:
+            logging.warning(f"The validators of {movie_path} couldn't be retrieved, {e}")
+            return movie_key, None, None, None
+
+        return movie_key, etag, size, None
+
+    return movie_path, None, None, None
+
+
+def connect_movies_metadata(db_path: str):
+    """
+    This function connects to the movies metadata cache stored next to the project db, and creates
+    its table if needed
+
+    :param db_path: the path to the project db
+    :return: Connection object
+    """
+    conn = sqlite3.connect(
+        os.path.join(os.path.dirname(os.path.abspath(db_path)), movies_metadata_db),
+        timeout=30,
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS movies_metadata (
+            movie_key TEXT PRIMARY KEY,
+            etag TEXT,
+            size INTEGER,
+            mtime REAL,
+            fps REAL,
+            frame_count INTEGER,
+            duration REAL,
+            codec TEXT,
+            width INTEGER,
+            height INTEGER,
+            keyframes TEXT,
+            probed_at REAL
+        )"""
+    )
+    return conn
+
+
+def get_movie_metadata(
+    movie_path: str,
+    db_path: str = None,
+    keyframes: bool = False,
+    max_age: float = None,
+    timeout: int = None,
+):
+    """
+    This function returns the fps, frame count, duration, codec, resolution and (optionally) keyframes of a movie.
+    If the path to the project db is given, the metadata is read from the movies metadata cache next to it and the
+    movie is only probed if it isn't cached yet, or it changed (different ETag, size or modification time) since
+    it was cached, or the cached metadata is older than max_age. Movies without any validator are always probed.
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param db_path: the path to the project db, defaults to not using the cache
+    :param keyframes: whether to include the times of the keyframes of the movie
+    :param max_age: the max number of seconds since the metadata was cached, defaults to no limit
+    :param timeout: the number of seconds after which reaching the movie is given up, defaults to no limit
+    :return: a dictionary with the metadata of the movie
+    """
+    if db_path is None:
+        movie_metadata = probe_movie_metadata(movie_path, timeout)
+        if keyframes:
+            movie_metadata["keyframes"] = probe_keyframes(movie_path) or []
+        return movie_metadata
+
+    movie_key, etag, size, mtime = get_movie_validators(movie_path, timeout or 30)
+    fields = ["fps", "frame_count", "duration", "codec", "width", "height", "keyframes"]
+
+    conn = connect_movies_metadata(db_path)
+    try:
+        row = conn.execute(
+            f"SELECT etag, size, mtime, probed_at, {', '.join(fields)} FROM movies_metadata WHERE movie_key = ?",
+            (movie_key,),
+        ).fetchone()
+
+        # Check the cached metadata is still valid
+        if (
+            row is not None
+            and any(v is not None for v in (etag, size, mtime))
+            and tuple(row[:3]) == (etag, size, mtime)
+            and (max_age is None or time.time() - row[3] <= max_age)
+        ):
+            movie_metadata = dict(zip(fields, row[4:]))
+        else:
+            movie_metadata = probe_movie_metadata(movie_path, timeout)
+            movie_metadata["keyframes"] = None
+            conn.execute(
+                f"INSERT OR REPLACE INTO movies_metadata (movie_key, etag, size, mtime, probed_at, {', '.join(fields)}) "
+                f"VALUES ({', '.join(['?'] * (len(fields) + 5))})",
+                (movie_key, etag, size, mtime, time.time(), *[movie_metadata[f] for f in fields]),
+            )
+            conn.commit()
+
+        # Probe the keyframes the first time they are needed
+        if keyframes and movie_metadata["keyframes"] is None:
+            movie_keyframes = probe_keyframes(movie_path)
+            if movie_keyframes is not None:
+                conn.execute(
+                    "UPDATE movies_metadata SET keyframes = ? WHERE movie_key = ?",
+                    (json.dumps(movie_keyframes), movie_key),
+                )
+                conn.commit()
+            movie_metadata["keyframes"] = movie_keyframes or []
+        elif isinstance(movie_metadata["keyframes"], str):
+            movie_metadata["keyframes"] = json.loads(movie_metadata["keyframes"])
+
+    finally:
+        conn.close()
+
+    movie_metadata["size"] = size
+
+    return movie_metadata
+
+
+def probe_keyframes(movie_path: str):
+    """
+    This function reads the times of the keyframes of a movie from the flags of the packets of its
+    video stream with ffprobe, without decoding the movie
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :return: A sorted list with the times (in seconds) of the keyframes, None if the movie couldn't be probed
+    """
+    try:
+        packets = subprocess.check_output(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "v:0",
+                "-show_entries",
+                "packet=pts_time,flags",
+                "-of",
+                "csv=p=0",
+                str(movie_path),
+            ],
+            text=True,
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        logging.warning(f"The keyframes of {movie_path} couldn't be probed, {e}")
+        return None
+
+    keyframes = []
+    for packet in packets.splitlines():
+        packet_info = packet.split(",")
+        if len(packet_info) > 1 and "K" in packet_info[1]:
+            try:
+                keyframes.append(float(packet_info[0]))
+            except ValueError:
+                continue
+
+    return sorted(keyframes)
+
+
+def probe_container_duration(movie_path: str):
+    """
+    This function reads the duration of a movie from its container with ffprobe (the end of its last stream
+    minus the start of its first one), rather than estimating it from the frame count and fps
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :return: The duration of the movie in seconds. Raises ValueError if it can't be read
+    """
+    try:
+        duration = subprocess.check_output(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "csv=p=0",
+                str(movie_path),
+            ],
+            text=True,
+        )
+        return float(duration.strip())
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+        raise ValueError(f"The duration of {movie_path} couldn't be probed, {e}")
+
+
+def get_keyframes(movie_path: str, db_path: str = None):
+    """
+    This function returns the times of the keyframes of a movie. They are probed once per session, or once
+    per movie if the path to the project db is given (see get_movie_metadata). The keyframes of the last
+    keyframes_cache_size movies are kept in memory while the size and ETag/modification time of the movie
+    don't change
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param db_path: the path to the project db, to read/store the keyframes in the movies metadata cache
+    :return: A sorted list with the times (in seconds) of the keyframes, empty if the movie couldn't be probed
+    """
+    # Movies without validators can't be checked, so they aren't kept in memory
+    validators = get_movie_validators(movie_path)
+    cacheable = any(v is not None for v in validators[1:])
+    with keyframes_lock:
+        if cacheable and validators in keyframes_cache:
+            keyframes_cache.move_to_end(validators)
+            return keyframes_cache[validators]
+
+    if db_path is None:
+        keyframes = probe_keyframes(movie_path) or []
     else:
-        duration = frame_count / fps
+        try:
+            keyframes = get_movie_metadata(movie_path, db_path, keyframes=True)[
+                "keyframes"
+            ]
+        except ValueError as e:
+            logging.warning(f"The metadata of {movie_path} couldn't be cached, {e}")
+            keyframes = probe_keyframes(movie_path) or []
+
+    if cacheable:
+        with keyframes_lock:
+            keyframes_cache[validators] = keyframes
+            while len(keyframes_cache) > keyframes_cache_size:
+                keyframes_cache.popitem(last=False)
+
+    return keyframes
+
+
+def snap_to_keyframe(movie_path: str, second: float, tolerance: float):
+    """
+    This function returns the time of the keyframe of a movie closest to a given second, so clips
+    starting there can be stream-copied instead of re-encoded
+
+    :param movie_path: a string containing the path (or url) where the movie of interest can be access from
+    :param second: the second of the movie of interest
+    :param tolerance: the max number of seconds between the second and the keyframe
+    :return: The time of the closest keyframe, or None if there isn't any within the tolerance
+    """
+    keyframes = get_keyframes(movie_path)
+
+    # Find the keyframes right before and after the second
+    i = bisect.bisect_left(keyframes, second)
+    closest_keyframes = keyframes[max(0, i - 1) : i + 1]
+
+    if not closest_keyframes:
+        return None
+
+    keyframe = min(closest_keyframes, key=lambda k: abs(k - second))
+    if abs(keyframe - second) > tolerance:
+        return None
+
+    return keyframe
+
+
+def iter_mp4_boxes(data: bytes, start: int = 0, end: int = None):
+    """
+    This function goes through the boxes (atoms) of a mp4/mov container stored in a bytes object
+
+    :param data: the bytes with the boxes
+    :param start: the position of the first box
+    :param end: the position where the boxes end, defaults to the end of the data
+    :return: a generator of tuples with the type, start of the content and end of each box
+    """
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        box_size, box_type = struct.unpack(">I4s", data[start : start + 8])
+        header_size = 8
+        if box_size == 1:
+            box_size = struct.unpack(">Q", data[start + 8 : start + 16])[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - start
+        if box_size < header_size:
+            return
+        yield box_type.decode("latin-1"), start + header_size, min(start + box_size, end)
+        start += box_size
+
+
+def find_mp4_box(data: bytes, box_path: list, start: int = 0, end: int = None):
+    """
+    This function returns the content of the first box found following a path of nested box types
+
+    :param data: the bytes with the boxes
+    :param box_path: a list of nested box types, e.g. ["mdia", "mdhd"]
+    :param start: the position of the first box
+    :param end: the position where the boxes end, defaults to the end of the data
+    :return: the start and end of the content of the box, or None if it wasn't found
+    """
+    for box_type, content_start, box_end in iter_mp4_boxes(data, start, end):
+        if box_type == box_path[0]:
+            if len(box_path) == 1:
+                return content_start, box_end
+            found = find_mp4_box(data, box_path[1:], content_start, box_end)
+            if found is not None:
+                return found
+    return None
+
+
+def read_mp4_timing(data: bytes, start: int):
+    """
+    This function reads the timescale and duration of a mvhd or mdhd box
+
+    :param data: the bytes with the box
+    :param start: the start of the content of the box
+    :return: the timescale and duration (in timescale units)
+    """
+    if data[start] == 1:
+        return struct.unpack(">IQ", data[start + 20 : start + 32])
+    return struct.unpack(">II", data[start + 12 : start + 20])
+
+
+def parse_moov_fps_duration(moov: bytes):
+    """
+    This function reads the fps and duration of a movie from the content of its moov box, which holds
+    the index of the mp4/mov container
+
+    :param moov: the content of the moov box
+    :return: Two floats, the fps and duration of the movie
+    """
+    # Get the duration of the movie
+    mvhd = find_mp4_box(moov, ["mvhd"])
+    if mvhd is None:
+        raise ValueError("The moov box doesn't have a mvhd box")
+    timescale, duration = read_mp4_timing(moov, mvhd[0])
+    duration = duration / timescale
+
+    # Get the number of frames and duration of the video track
+    for box_type, trak_start, trak_end in iter_mp4_boxes(moov):
+        if box_type != "trak":
+            continue
+        hdlr = find_mp4_box(moov, ["mdia", "hdlr"], trak_start, trak_end)
+        if hdlr is None or moov[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+            continue
+
+        mdhd = find_mp4_box(moov, ["mdia", "mdhd"], trak_start, trak_end)
+        stts = find_mp4_box(
+            moov, ["mdia", "minf", "stbl", "stts"], trak_start, trak_end
+        )
+        if mdhd is None or stts is None:
+            continue
+        track_timescale, track_duration = read_mp4_timing(moov, mdhd[0])
+
+        # Add up the samples (frames) of the time-to-sample table
+        n_entries = struct.unpack(">I", moov[stts[0] + 4 : stts[0] + 8])[0]
+        frame_count = sum(
+            struct.unpack(">II", moov[i : i + 8])[0]
+            for i in range(stts[0] + 8, stts[0] + 8 + 8 * n_entries, 8)
+        )
+
+        if track_duration > 0:
+            return frame_count * track_timescale / track_duration, duration
+
+    raise ValueError("The moov box doesn't have a video track")
+
+
+def probe_mp4_fps_duration(read_range, file_size: int):
+    """
+    This function gets the fps and duration of a mp4/mov movie reading only the headers of its top-level
+    boxes and its moov box (the index of the container), instead of the whole movie
+
+    :param read_range: a function that returns the bytes of the movie between two positions (both included),
+    e.g. with a ranged GET of the movie
+    :param file_size: the size of the movie in bytes
+    :return: Two floats, the fps and duration of the movie
+    """
+    position = 0
+    while position + 8 <= file_size:
+        header = read_range(position, min(position + 15, file_size - 1))
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if box_size == 1:
+            box_size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = file_size - position
+        if box_size < header_size:
+            break
+
+        if box_type == b"moov":
+            moov = read_range(position + header_size, position + box_size - 1)
+            return parse_moov_fps_duration(moov)
+
+        # Skip the rest of the box (e.g. the mdat with the frames)
+        position += box_size
+
+    raise ValueError("The movie doesn't have a moov box")
+
+
+class MovieReaderPool:
+    """
+    A bounded pool of movie readers (decoder handles). The readers are opened lazily, the first time
+    a movie is requested, and when more than max_open movies are open the least recently used reader is
+    closed. Request the frames ordered by (movie, frame) so each reader is used sequentially before it
+    is evicted
+    """
 
-    return fps, duration
+    def __init__(self, max_open: int = 4, opener: Callable = None):
+        """
+        :param max_open: the maximum number of readers kept open at the same time
+        :param opener: a function opening the reader of a movie path, defaults to pims.Video
+        """
+        self.max_open = max(1, max_open)
+        self.opener = opener or pims.Video
+        self.readers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, movie_path: str):
+        """
+        > This function returns the reader of a movie, opening it (and closing the least recently used
+        reader) if it isn't open
+
+        :param movie_path: the path (or url) of the movie
+        :return: the reader of the movie
+        """
+        with self.lock:
+            if movie_path in self.readers:
+                self.readers.move_to_end(movie_path)
+                return self.readers[movie_path]
+
+            while len(self.readers) >= self.max_open:
+                _, reader = self.readers.popitem(last=False)
+                close_movie_reader(reader)
+
+            reader = self.opener(movie_path)
+            self.readers[movie_path] = reader
+            return reader
+
+    def close(self):
+        """
+        > This function closes all the open readers
+        """
+        with self.lock:
+            while self.readers:
+                _, reader = self.readers.popitem(last=False)
+                close_movie_reader(reader)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def close_movie_reader(reader):
+    """
+    > This function closes a movie reader, logging instead of raising if the decoder fails to close
+
+    :param reader: a pims reader
+    """
+    try:
+        reader.close()
+        # MoviePyReader keeps the ffmpeg process in its clip
+        if hasattr(reader, "clip"):
+            reader.clip.close()
+    except Exception as e:
+        logging.warning(f"Failed to close the reader of a movie, {e}")
 
 
 def get_movie_path(f_path: str, db_info_dict: dict, project: project_utils.Project):
@@ -82,31 +673,25 @@ def get_movie_extensions():
     return movie_formats
 
 
-def standarise_movie_format(
+def check_movie_format(
     movie_path: str,
     movie_filename: str,
-    f_path: str,
     db_info_dict: dict,
     project: project_utils.Project,
-    gpu_available: bool = False,
 ):
-
     """
-    This function reviews the movie metadata. If the movie is not in the correct format, frame rate or codec,
-    it is converted using ffmpeg.
+    This function reviews the movie metadata, and checks if the movie needs to be converted (because of its
+    format, frame rate or codec) and/or compressed
 
-    :param movie_path: The local path- or url to the movie file you want to convert
-    :type movie_path: str
-    :param movie_filename: The filename of the movie file you want to convert
-    :type movie_filename: str
-    :param f_path: The server or storage path of the original movie you want to convert
-    :type f_path: str
+    :param movie_path: The local path- or url to the movie file you want to check
+    :param movie_filename: The filename of the movie file you want to check
     :param db_info_dict: a dictionary with the initial information of the project
     :param project: the project object
-    :param gpu_available: Boolean, whether or not a GPU is available
-    :type gpu_available: bool
+    :return: Whether the movie needs to be converted, whether it needs to be compressed, and its metadata
     """
 
+    convert_video_T_F = False
+
     ##### Check movie format ######
     filename, ext = os.path.splitext(movie_filename)
 
@@ -115,9 +700,11 @@ def standarise_movie_format(
         # Set conversion to True
         convert_video_T_F = True
 
+    # Get the metadata of the movie (from the cache if available)
+    movie_metadata = get_movie_metadata(movie_path, db_info_dict.get("db_path"))
+
     ##### Check frame rate #######
-    cap = cv2.VideoCapture(movie_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    fps = movie_metadata["fps"]
 
     if not float(fps).is_integer():
         logging.info(f"Variable frame rate of {movie_filename} not supported.")
@@ -125,13 +712,7 @@ def standarise_movie_format(
         convert_video_T_F = True
 
     ##### Check codec info ########
-    h = int(cap.get(cv2.CAP_PROP_FOURCC))
-    codec = (
-        chr(h & 0xFF)
-        + chr((h >> 8) & 0xFF)
-        + chr((h >> 16) & 0xFF)
-        + chr((h >> 24) & 0xFF)
-    )
+    codec = movie_metadata["codec"]
 
     if not codec == "h264":
         logging.info(
@@ -151,12 +732,15 @@ def standarise_movie_format(
 
     else:
         # Check movie filesize in relation to its duration
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count / fps
+        duration = movie_metadata["duration"]
         duration_mins = duration / 60
 
+        # Check if the size of the movie is known already
+        if movie_metadata.get("size") is not None:
+            size = movie_metadata["size"]
+
         # Check if the movie is accessible locally
-        if os.path.exists(movie_path):
+        elif os.path.exists(movie_path):
             # Store the size of the movie
             size = os.path.getsize(movie_path)
 
@@ -184,6 +768,37 @@ def standarise_movie_format(
             # Set movie compression to false
             compress_video = False
 
+    return convert_video_T_F, compress_video, movie_metadata
+
+
+def standarise_movie_format(
+    movie_path: str,
+    movie_filename: str,
+    f_path: str,
+    db_info_dict: dict,
+    project: project_utils.Project,
+    gpu_available: bool = False,
+):
+
+    """
+    This function reviews the movie metadata. If the movie is not in the correct format, frame rate or codec,
+    it is converted using ffmpeg.
+
+    :param movie_path: The local path- or url to the movie file you want to convert
+    :type movie_path: str
+    :param movie_filename: The filename of the movie file you want to convert
+    :type movie_filename: str
+    :param f_path: The server or storage path of the original movie you want to convert
+    :type f_path: str
+    :param db_info_dict: a dictionary with the initial information of the project
+    :param project: the project object
+    :param gpu_available: Boolean, whether or not a GPU is available
+    :type gpu_available: bool
+    """
+    convert_video_T_F, compress_video, movie_metadata = check_movie_format(
+        movie_path, movie_filename, db_info_dict, project
+    )
+
     # Start converting/compressing video if movie didn't pass any of the checks
     if convert_video_T_F or compress_video:
         conv_mov_path = convert_video(
@@ -197,6 +812,262 @@ def standarise_movie_format(
         logging.info(f"{movie_filename} format is standard.")
 
 
+# Lock to append jobs to the transcoding journals from several threads
+journal_lock = threading.Lock()
+
+
+def read_transcode_journal(journal_path: str):
+    """
+    This function reads the journal of the transcoding jobs, so interrupted runs can be resumed
+
+    :param journal_path: the path to the journal (a json lines file)
+    :return: a dictionary with the latest entry of each job, by the server path of its movie
+    """
+    journal = {}
+    if os.path.exists(journal_path):
+        with open(journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip lines cut by an interruption
+                    continue
+                journal[entry["f_path"]] = entry
+    return journal
+
+
+def write_transcode_journal(journal_path: str, f_path: str, state: str, **info):
+    """
+    This function appends the new state of a transcoding job to the journal
+
+    :param journal_path: the path to the journal (a json lines file)
+    :param f_path: the server or storage path of the original movie of the job
+    :param state: the stage the job has completed (standard, fetched, encoded, uploaded or failed)
+    :param info: other information of the job to keep (e.g. the path to the converted movie)
+    """
+    entry = {"f_path": f_path, "state": state, "time": time.time(), **info}
+    with journal_lock:
+        with open(journal_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def fetch_movie(movie_path: str, movie_filename: str, work_dir: str):
+    """
+    This function downloads a movie to the work folder of the transcoding jobs, unless it is local already.
+    Each movie is downloaded to its own subfolder, named by the hash of its url (without the query), so
+    movies with the same filename in different folders (e.g. GOPR0001.MP4) don't overwrite each other
+
+    :param movie_path: The local path- or url to the movie file
+    :param movie_filename: The filename of the movie file
+    :param work_dir: the folder to download the movie to
+    :return: The local path to the movie, and whether it was downloaded
+    """
+    if os.path.exists(movie_path):
+        return movie_path, False
+
+    url = urllib.parse.urlsplit(movie_path)
+    movie_dir = os.path.join(
+        work_dir,
+        hashlib.sha1(f"{url.scheme}://{url.netloc}{url.path}".encode()).hexdigest(),
+    )
+    os.makedirs(movie_dir, exist_ok=True)
+    local_path = os.path.join(movie_dir, movie_filename)
+    with urllib.request.urlopen(movie_path) as response, open(local_path, "wb") as f:
+        shutil.copyfileobj(response, f, 16 * 1024 * 1024)
+
+    return local_path, True
+
+
+def transcode_movies(
+    movies_df: pd.DataFrame,
+    db_info_dict: dict,
+    project: project_utils.Project,
+    gpu_available: bool = False,
+    fetch_pool_size: int = 2,
+    encode_pool_size: int = 1,
+    upload_pool_size: int = 2,
+    disk_budget: int = 50 * 1024**3,
+    work_dir: str = "transcode_tmp",
+    journal_path: str = None,
+    col_fpath: str = "fpath",
+    force: bool = False,
+):
+    """
+    This function standardises the format, frame rate and codec of several movies (see standarise_movie_format)
+    in a pipeline. Each movie goes through three stages: fetch (download the movie), encode (convert_video) and
+    upload (server_utils.upload_movie_server), and different movies run different stages at the same time.
+
+    Each stage has its own number of concurrent jobs, and jobs only start fetching when the space their files
+    will take (twice the size of the movie) fits in the disk budget. The stage completed by each job is written
+    to a journal, so if the run is interrupted (or a job fails) the movies already uploaded are skipped, and the
+    movies already encoded go straight to the upload stage. The journal entries keep the validators of the movie
+    (see get_movie_validators), and are ignored if the movie changed (or can't be validated) since.
+
+    :param movies_df: a dataframe with the movie_path, filename and server path (see col_fpath) of the movies
+    :param db_info_dict: a dictionary with the initial information of the project
+    :param project: the project object
+    :param gpu_available: Boolean, whether or not a GPU is available
+    :param fetch_pool_size: the max number of movies downloaded at the same time, defaults to 2
+    :param encode_pool_size: the max number of movies encoded at the same time, defaults to 1
+    :param upload_pool_size: the max number of movies uploaded at the same time, defaults to 2
+    :param disk_budget: the max number of bytes the files of the jobs can take in the work folder, defaults to 50GB
+    :param work_dir: the folder to store the downloaded and converted movies
+    :param journal_path: the path to the journal of the jobs, defaults to transcode_journal.jsonl next to the project db
+    :param col_fpath: the name of the column with the server or storage path of the movies, defaults to fpath
+    :param force: ignore the journal and process all the movies again, defaults to False
+    :return: a dataframe with the final state of each job and the encode fps of the converted movies
+    """
+    if journal_path is None:
+        journal_path = os.path.join(
+            os.path.dirname(os.path.abspath(db_info_dict["db_path"])),
+            "transcode_journal.jsonl",
+        )
+    journal = read_transcode_journal(journal_path)
+
+    if not os.path.exists(work_dir):
+        os.mkdir(work_dir)
+
+    # Limit the number of jobs in each stage
+    fetch_sem = threading.Semaphore(fetch_pool_size)
+    encode_sem = threading.Semaphore(encode_pool_size)
+    upload_sem = threading.Semaphore(upload_pool_size)
+
+    # Keep track of the disk space reserved by the jobs
+    disk_cond = threading.Condition()
+    disk_used = [0]
+
+    def reserve_disk(n_bytes):
+        with disk_cond:
+            # Let a single job run even if it is bigger than the budget
+            disk_cond.wait_for(
+                lambda: disk_used[0] == 0 or disk_used[0] + n_bytes <= disk_budget
+            )
+            disk_used[0] += n_bytes
+
+    def release_disk(n_bytes):
+        with disk_cond:
+            disk_used[0] -= n_bytes
+            disk_cond.notify_all()
+
+    def transcode_job(movie_info):
+        movie_path, movie_filename, f_path = movie_info
+
+        # Only trust the journal if the movie didn't change since the job was journaled
+        validators = list(get_movie_validators(movie_path)[1:])
+        job = journal.get(f_path, {})
+        if (
+            force
+            or all(v is None for v in validators)
+            or job.get("validators") != validators
+        ):
+            job = {}
+
+        if job.get("state") in ["uploaded", "standard"]:
+            logging.info(f"{movie_filename} was already processed, skipping it")
+            return job
+
+        reserved = 0
+        conv_path = job.get("conv_path")
+        encode_fps = job.get("encode_fps")
+        local_path, downloaded = None, False
+        try:
+            # Skip the fetch and encode stages of the movies already encoded
+            if not (conv_path and os.path.exists(conv_path)):
+                convert_video_T_F, compress_video, movie_metadata = check_movie_format(
+                    movie_path, movie_filename, db_info_dict, project
+                )
+                if not (convert_video_T_F or compress_video):
+                    logging.info(f"{movie_filename} format is standard.")
+                    write_transcode_journal(
+                        journal_path, f_path, "standard", validators=validators
+                    )
+                    return {"f_path": f_path, "state": "standard"}
+
+                # Reserve space for the movie and its converted version
+                reserved = 2 * (movie_metadata.get("size") or 0)
+                reserve_disk(reserved)
+
+                with fetch_sem:
+                    local_path, downloaded = fetch_movie(
+                        movie_path, movie_filename, work_dir
+                    )
+                write_transcode_journal(
+                    journal_path, f_path, "fetched", validators=validators
+                )
+
+                with encode_sem:
+                    start_time = time.perf_counter()
+                    conv_path = convert_video(
+                        local_path, movie_filename, gpu_available, compress_video
+                    )
+                    encode_fps = movie_metadata["frame_count"] / (
+                        time.perf_counter() - start_time
+                    )
+                logging.info(f"{movie_filename} encoded at {encode_fps:.1f} fps")
+                write_transcode_journal(
+                    journal_path,
+                    f_path,
+                    "encoded",
+                    conv_path=conv_path,
+                    encode_fps=encode_fps,
+                    validators=validators,
+                )
+
+                # Remove the downloaded movie once it is converted
+                if downloaded:
+                    os.remove(local_path)
+                    downloaded = False
+
+            with upload_sem:
+                server_utils.upload_movie_server(
+                    conv_path, f_path, db_info_dict, project
+                )
+            os.remove(conv_path)
+
+            # Keep the validators of the uploaded movie, which replaced the original
+            write_transcode_journal(
+                journal_path,
+                f_path,
+                "uploaded",
+                encode_fps=encode_fps,
+                validators=list(get_movie_validators(movie_path)[1:]),
+            )
+            return {"f_path": f_path, "state": "uploaded", "encode_fps": encode_fps}
+
+        except Exception as e:
+            logging.error(f"The transcoding of {movie_filename} failed, {e}")
+            write_transcode_journal(
+                journal_path,
+                f_path,
+                "failed",
+                error=str(e),
+                conv_path=conv_path,
+                encode_fps=encode_fps,
+                validators=validators,
+            )
+            return {"f_path": f_path, "state": "failed", "error": str(e)}
+
+        finally:
+            # Remove the downloaded movie if its transcoding failed
+            if downloaded and os.path.exists(local_path):
+                os.remove(local_path)
+            release_disk(reserved)
+
+    # Run enough jobs at the same time to keep all the stages busy
+    movies_info = list(
+        zip(movies_df["movie_path"], movies_df["filename"], movies_df[col_fpath])
+    )
+    with Pool(fetch_pool_size + encode_pool_size + upload_pool_size) as pool:
+        jobs = list(
+            tqdm(
+                pool.imap_unordered(transcode_job, movies_info),
+                total=len(movies_info),
+            )
+        )
+
+    return pd.DataFrame(jobs)
+
+
 def convert_video(
     movie_path: str,
     movie_filename: str,
@@ -215,7 +1086,7 @@ def convert_video(
     :type gpu_available: bool
     :param compression: Boolean, whether or not movie compression is required
     :type compression: bool
-    :return: The path to the converted video file.
+    :return: The path to the converted video file. Raises CalledProcessError if ffmpeg fails
     """
     conv_filename = "conv_" + movie_filename
 
@@ -233,67 +1104,73 @@ def convert_video(
     else:
         logging.error("The path to", movie_path, " is invalid")
 
-    if gpu_available and compression:
-        subprocess.call(
-            [
-                "ffmpeg",
-                "-hwaccel",
-                "cuda",
-                "-hwaccel_output_format",
-                "cuda",
-                "-i",
-                str(movie_path),
-                "-c:v",
-                "h264_nvenc",  # ensures correct codec
-                "-crf",
-                "22",  # compresses the video
-                str(conv_fpath),
-            ]
-        )
+    # Raise if ffmpeg fails, removing the incomplete movie
+    try:
+        if gpu_available and compression:
+            subprocess.check_call(
+                [
+                    "ffmpeg",
+                    "-hwaccel",
+                    "cuda",
+                    "-hwaccel_output_format",
+                    "cuda",
+                    "-i",
+                    str(movie_path),
+                    "-c:v",
+                    "h264_nvenc",  # ensures correct codec
+                    "-crf",
+                    "22",  # compresses the video
+                    str(conv_fpath),
+                ]
+            )
 
-    elif gpu_available and not compression:
-        subprocess.call(
-            [
-                "ffmpeg",
-                "-hwaccel",
-                "cuda",
-                "-hwaccel_output_format",
-                "cuda",
-                "-i",
-                str(movie_path),
-                "-c:v",
-                "h264_nvenc",  # ensures correct codec
-                str(conv_fpath),
-            ]
-        )
+        elif gpu_available and not compression:
+            subprocess.check_call(
+                [
+                    "ffmpeg",
+                    "-hwaccel",
+                    "cuda",
+                    "-hwaccel_output_format",
+                    "cuda",
+                    "-i",
+                    str(movie_path),
+                    "-c:v",
+                    "h264_nvenc",  # ensures correct codec
+                    str(conv_fpath),
+                ]
+            )
 
-    elif not gpu_available and compression:
-        subprocess.call(
-            [
-                "ffmpeg",
-                "-i",
-                str(movie_path),
-                "-c:v",
-                "h264",  # ensures correct codec
-                "-crf",
-                "22",  # compresses the video
-                str(conv_fpath),
-            ]
-        )
+        elif not gpu_available and compression:
+            subprocess.check_call(
+                [
+                    "ffmpeg",
+                    "-i",
+                    str(movie_path),
+                    "-c:v",
+                    "h264",  # ensures correct codec
+                    "-crf",
+                    "22",  # compresses the video
+                    str(conv_fpath),
+                ]
+            )
 
-    elif not gpu_available and not compression:
-        subprocess.call(
-            [
-                "ffmpeg",
-                "-i",
-                str(movie_path),
-                "-c:v",
-                "h264",  # ensures correct codec
-                str(conv_fpath),
-            ]
-        )
-    else:
-        raise ValueError(f"{movie_path} not modified")
+        elif not gpu_available and not compression:
+            subprocess.check_call(
+                [
+                    "ffmpeg",
+                    "-i",
+                    str(movie_path),
+                    "-c:v",
+                    "h264",  # ensures correct codec
+                    str(conv_fpath),
+                ]
+            )
+        else:
+            raise ValueError(f"{movie_path} not modified")
+    except subprocess.CalledProcessError:
+        if os.path.exists(conv_fpath):
+            os.remove(conv_fpath)
+        raise
 
     # Ensure open permissions on file (for now)
     os.chmod(conv_fpath, 0o777)
@@ -0,0 +1,224 @@
+# base imports
+import os
+import shutil
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs as fs
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# util imports
+import kso_utils.db_utils as db_utils
+
+# Logging
+logging.basicConfig()
+logging.getLogger().setLevel(logging.INFO)
+
+# Column used to partition the parquet files of each table
+partition_cols = {
+    "sites": None,
+    "species": None,
+    "movies": "site_id",
+    "subjects": "movie_id",
+    "agg_annotations_clip": "movie_id",
+    "agg_annotations_frame": "movie_id",
+}
+
+# Number of rows read from sqlite or parquet at a time
+chunk_size = 100000
+
+
+def table_query(table_name: str):
+    """
+    > This function returns the query used to export a table. The aggregated annotations are
+    joined with their subjects to get the movie_id they are partitioned by
+
+    :param table_name: the name of the table of interest
+    :return: a SQL query
+    """
+    if table_name.startswith("agg_annotations"):
+        return (
+            f"SELECT a.*, s.movie_id FROM {table_name} AS a "
+            f"LEFT JOIN subjects AS s ON a.subject_id = s.id"
+        )
+    return f"SELECT * FROM {table_name}"
+
+
+def export_db_to_parquet(db_path: str, export_dir: str, tables: list = None):
+    """
+    > This function writes the tables of the project database to parquet datasets, one folder
+    per table partitioned by movie or site (see partition_cols), so they can be read column-wise
+    without going through sqlite
+
+    :param db_path: the path to the database
+    :param export_dir: the folder to write the parquet datasets to
+    :param tables: the names of the tables to export, defaults to all the tables in partition_cols
+    """
+    conn = db_utils.get_connection(db_path, read_only=True)
+
+    for table_name in tables or partition_cols.keys():
+        table_dir = os.path.join(export_dir, table_name)
+
+        # Remove previous exports of the table
+        if os.path.exists(table_dir):
+            shutil.rmtree(table_dir)
+
+        partition_col = partition_cols[table_name]
+        n_rows = 0
+        for chunk_df in pd.read_sql_query(
+            table_query(table_name), conn, chunksize=chunk_size
+        ):
+            pq.write_to_dataset(
+                pa.Table.from_pandas(chunk_df, preserve_index=False),
+                table_dir,
+                partition_cols=[partition_col] if partition_col else None,
+            )
+            n_rows += len(chunk_df)
+
+        logging.info(f"Exported {n_rows} rows of {table_name} to {table_dir}")
+
+    # Check the exported tables can be read back
+    check_parquet_export(db_path, export_dir, tables)
+
+
+def open_parquet_table(export_dir: str, table_name: str):
+    """
+    > This function opens a table exported by export_db_to_parquet as a pyarrow dataset. The
+    partition values are read as plain values, not dictionaries, so the NULL partition
+    (__HIVE_DEFAULT_PARTITION__) of rows without a movie or site is read as null
+
+    :param export_dir: the folder with the parquet datasets
+    :param table_name: the name of the table of interest
+    :return: a pyarrow dataset
+    """
+    return ds.dataset(
+        os.path.join(export_dir, table_name),
+        format="parquet",
+        partitioning=ds.HivePartitioning.discover(infer_dictionary=False),
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def read_parquet_table(
+    export_dir: str, table_name: str, columns: list = None, filters=None
+):
+    """
+    > This function reads a table exported by export_db_to_parquet into a dataframe. The parquet
+    files are memory-mapped and only the columns and partitions of interest are read
+
+    :param export_dir: the folder with the parquet datasets
+    :param table_name: the name of the table of interest
+    :param columns: the columns to read, defaults to all
+    :param filters: pyarrow filters on the rows, e.g. [("movie_id", "=", 5)]
+    :return: A dataframe with the table of interest
+    """
+    table = open_parquet_table(export_dir, table_name).to_table(
+        columns=columns,
+        filter=pq.filters_to_expression(filters) if filters else None,
+    )
+    df = table.to_pandas()
+
+    # Make sure the partition columns are numeric
+    partition_col = partition_cols.get(table_name)
+    if partition_col in df.columns:
+        df[partition_col] = pd.to_numeric(df[partition_col].astype(object))
+
+    return df
+
+
+def check_parquet_export(db_path: str, export_dir: str, tables: list = None):
+    """
+    > This function checks that the tables exported by export_db_to_parquet read back with the
+    same number of rows as the database, including the rows with a NULL partition value
+
+    :param db_path: the path to the database
+    :param export_dir: the folder with the parquet datasets
+    :param tables: the names of the tables to check, defaults to all the tables in partition_cols
+    """
+    conn = db_utils.get_connection(db_path, read_only=True)
+
+    for table_name in tables or partition_cols.keys():
+        partition_col = partition_cols[table_name]
+        db_rows = conn.execute(
+            f"SELECT COUNT(*) FROM ({table_query(table_name)})"
+        ).fetchone()[0]
+        if not os.path.exists(os.path.join(export_dir, table_name)):
+            parquet_rows = 0
+        else:
+            parquet_rows = open_parquet_table(export_dir, table_name).count_rows()
+        if db_rows != parquet_rows:
+            raise ValueError(
+                f"The parquet export of {table_name} has {parquet_rows} rows, "
+                f"the database has {db_rows}"
+            )
+
+        if partition_col and db_rows:
+            db_nulls = conn.execute(
+                f"SELECT COUNT(*) FROM ({table_query(table_name)}) "
+                f"WHERE {partition_col} IS NULL"
+            ).fetchone()[0]
+            parquet_nulls = open_parquet_table(export_dir, table_name).count_rows(
+                filter=ds.field(partition_col).is_null()
+            )
+            if db_nulls != parquet_nulls:
+                raise ValueError(
+                    f"The parquet export of {table_name} has {parquet_nulls} rows without "
+                    f"{partition_col}, the database has {db_nulls}"
+                )
+
+
+def import_parquet_to_db(db_path: str, export_dir: str, tables: list = None):
+    """
+    > This function loads the parquet datasets written by export_db_to_parquet into the project
+    database in a single bulk-load transaction. The tables are loaded in dependency order and the
+    rows whose id already exists are updated
+
+    :param db_path: the path to the database
+    :param export_dir: the folder with the parquet datasets
+    :param tables: the names of the tables to import, defaults to all the tables in partition_cols
+    """
+    conn = db_utils.begin_bulk_load(db_path)
+
+    try:
+        for table_name in tables or partition_cols.keys():
+            table_dir = os.path.join(export_dir, table_name)
+            if not os.path.exists(table_dir):
+                logging.info(f"No parquet files found for {table_name}, skipping it")
+                continue
+
+            # Get the fields of the table in schema order
+            field_names = [
+                i[1] for i in conn.execute(f"PRAGMA table_info({table_name})")
+            ]
+
+            dataset = open_parquet_table(export_dir, table_name)
+            n_rows = 0
+            for batch in dataset.to_batches(batch_size=chunk_size):
+                chunk_df = batch.to_pandas()
+
+                # Make sure the partition columns are numeric
+                partition_col = partition_cols[table_name]
+                if partition_col in chunk_df.columns:
+                    chunk_df[partition_col] = pd.to_numeric(
+                        chunk_df[partition_col].astype(object)
+                    )
+
+                chunk_df = chunk_df.astype(object).where(chunk_df.notnull(), None)
+                db_utils.add_to_table(
+                    db_path,
+                    table_name,
+                    [tuple(i) for i in chunk_df[field_names].values],
+                    len(field_names),
+                    conn=conn,
+                    upsert=True,
+                )
+                n_rows += len(chunk_df)
+
+            logging.info(f"Imported {n_rows} rows of {table_name} from {table_dir}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Commit (unless rolled back), restore the pragmas and build the deferred indexes
+        db_utils.end_bulk_load(conn)
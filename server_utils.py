@@ -9,8 +9,12 @@ import gdown
 import zipfile
 import boto3
 import paramiko
+import time
 import logging
+import threading
+import subprocess
 from tqdm import tqdm
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from paramiko import SFTPClient, SSHClient
 
@@ -385,7 +389,7 @@ def retrieve_movie_info_from_server(project: project_utils.Project, db_info_dict
         raise ValueError("The server type you selected is not currently supported.")
 
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Query info about the movie of interest
     movies_df = pd.read_sql_query("SELECT * FROM movies", conn)
@@ -647,6 +651,22 @@ def download_object_from_s3(
         )
 
 
+def read_s3_range(client: boto3.client, *, bucket: str, key: str, start: int, end: int):
+    """
+    > Read a range of bytes of an object in S3 with a ranged GET, without downloading the rest of it
+
+    :param client: The boto3 client to use
+    :param bucket: The name of the bucket of the object
+    :param key: The name of the object in S3
+    :param start: The position of the first byte to read
+    :param end: The position of the last byte to read (included)
+    :return: The bytes of the range
+    """
+    return client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")[
+        "Body"
+    ].read()
+
+
 def upload_file_to_s3(client: boto3.client, *, bucket: str, key: str, filename: str):
     """
     > Upload a file to S3, and show a progress bar if the file is large enough
@@ -698,6 +718,301 @@ def delete_file_from_s3(client: boto3.client, *, bucket: str, key: str):
     client.delete_object(Bucket=bucket, Key=key)
 
 
+def upload_stream_to_s3(
+    client: boto3.client,
+    stream,
+    *,
+    bucket: str,
+    key: str,
+    part_size: int = 64 * 1024 * 1024,
+):
+    """
+    > Upload the content of a stream (e.g. the output of ffmpeg) to S3 with a multipart upload, as it is
+    produced and without storing it locally. The upload is aborted if anything fails
+
+    :param client: The boto3 client to use
+    :param stream: a binary file-like object to read the content from
+    :param bucket: The name of the bucket to upload to
+    :param key: The name of the file in S3
+    :param part_size: The number of bytes of each part (at least 5MB), defaults to 64MB
+    :return: The number of bytes uploaded
+    """
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    parts = []
+    n_bytes = 0
+
+    try:
+        while True:
+            # Fill a whole part (reads from pipes can return less than requested)
+            part = b""
+            while len(part) < part_size:
+                chunk = stream.read(part_size - len(part))
+                if not chunk:
+                    break
+                part += chunk
+
+            # Upload the part (an empty object still needs one part)
+            if part or not parts:
+                response = client.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=part,
+                )
+                parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+                n_bytes += len(part)
+
+            if len(part) < part_size:
+                break
+
+        client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    return n_bytes
+
+
+def concatenate_s3_videos(
+    client: boto3.client,
+    *,
+    bucket: str,
+    keys: list,
+    key: str,
+    codec_args: list = None,
+    pool_size: int = 4,
+    disk_budget: int = 20 * 1024 * 1024 * 1024,
+    tmp_dir: str = ".",
+    part_size: int = 64 * 1024 * 1024,
+    duration_tolerance: float = 1.0,
+):
+    """
+    > Concatenate several videos (e.g. the chapters of a GoPro deployment) stored in S3 into a new video
+    in S3, in a pipeline. The videos are downloaded concurrently, fed to ffmpeg in order as soon as they are
+    downloaded (and removed right after), and the output of ffmpeg is uploaded with a multipart upload while
+    it is produced. Only the downloaded videos are stored locally, within the disk budget.
+
+    Each video is remuxed to mpeg-ts, with its timestamps shifted by the duration of the previous videos (read
+    from their containers with ffprobe), and piped into a single ffmpeg process. As its output isn't seekable,
+    the concatenated video is first uploaded as a fragmented mp4, which has an empty index (moov box). It is
+    then remuxed from S3 into a regular mp4 with its index at the start (faststart), in tmp_dir, so its fps and
+    duration can be read from its headers (see movie_utils.probe_mp4_fps_duration), and uploaded again. The
+    remux needs as much disk space as the concatenated video, once all the videos are concatenated.
+
+    Once uploaded, the concatenated video is probed from S3, and it is removed (raising ValueError) unless its
+    duration matches the sum of the durations of the videos, so the original videos are only deleted by the
+    callers once the concatenated video is known to be readable.
+
+    :param client: The boto3 client to use
+    :param bucket: The name of the bucket with the videos
+    :param keys: The names of the videos to concatenate, in order
+    :param key: The name of the concatenated video in S3
+    :param codec_args: the ffmpeg arguments to encode the concatenated video, defaults to copying the streams
+    :param pool_size: The max number of videos downloaded at the same time, defaults to 4
+    :param disk_budget: The max number of bytes the downloaded videos can take, defaults to 20GB
+    :param tmp_dir: The folder to download the videos to
+    :param part_size: The number of bytes of each part of the multipart upload, defaults to 64MB
+    :param duration_tolerance: The max difference (in seconds) between the duration of the concatenated video
+    and the sum of the durations of the videos, defaults to 1 second
+    :return: The number of bytes of the concatenated video
+    """
+    if codec_args is None:
+        codec_args = ["-c", "copy"]
+
+    # Keep track of the disk space taken by the downloaded videos
+    disk_cond = threading.Condition()
+    disk_used = [0]
+
+    def release_disk(n_bytes):
+        with disk_cond:
+            disk_used[0] -= n_bytes
+            disk_cond.notify_all()
+
+    def download_video(video_key, filename):
+        client.download_file(bucket, video_key, filename)
+        return filename
+
+    # Reserve the disk space of the videos in order, so the first ones are never waiting for the next ones
+    video_sizes = [client.head_object(Bucket=bucket, Key=k)["ContentLength"] for k in keys]
+    downloads = []
+    stop = threading.Event()
+
+    def schedule_downloads(pool):
+        for i, (video_key, video_size) in enumerate(zip(keys, video_sizes)):
+            with disk_cond:
+                # Let a single video be downloaded even if it is bigger than the budget
+                disk_cond.wait_for(
+                    lambda: stop.is_set()
+                    or disk_used[0] == 0
+                    or disk_used[0] + video_size <= disk_budget
+                )
+                if stop.is_set():
+                    return
+                disk_used[0] += video_size
+            filename = os.path.join(tmp_dir, f"concat_{i}_" + video_key.split("/")[-1])
+            downloads.append(pool.apply_async(download_video, (video_key, filename)))
+
+    # Start ffmpeg reading mpeg-ts from stdin and writing a fragmented mp4 to stdout
+    concat_process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "mpegts",
+            "-i",
+            "pipe:0",
+            *codec_args,
+            "-movflags",
+            "frag_keyframe+empty_moov+default_base_moof",
+            "-f",
+            "mp4",
+            "pipe:1",
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+
+    # Upload the output of ffmpeg while it is produced
+    upload_result = {}
+
+    def upload_output():
+        try:
+            upload_result["n_bytes"] = upload_stream_to_s3(
+                client, concat_process.stdout, bucket=bucket, key=key, part_size=part_size
+            )
+        except Exception as e:
+            upload_result["error"] = e
+            # Keep draining ffmpeg so it doesn't block
+            while concat_process.stdout.read(part_size):
+                pass
+
+    uploader = threading.Thread(target=upload_output)
+    uploader.start()
+
+    pool = ThreadPool(pool_size)
+    scheduler = threading.Thread(target=schedule_downloads, args=(pool,))
+    scheduler.start()
+
+    try:
+        offset = 0.0
+        for i, video_size in enumerate(tqdm(video_sizes, desc=key)):
+            # Wait for the video to be downloaded
+            while len(downloads) <= i:
+                time.sleep(0.1)
+            filename = downloads[i].get()
+
+            # Feed the video to the concatenation, shifting its timestamps after the previous videos
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-loglevel",
+                    "error",
+                    "-i",
+                    filename,
+                    "-map",
+                    "0:v:0",
+                    "-map",
+                    "0:a?",
+                    "-c",
+                    "copy",
+                    "-output_ts_offset",
+                    str(offset),
+                    "-f",
+                    "mpegts",
+                    "pipe:1",
+                ],
+                stdout=concat_process.stdin,
+                check=True,
+            )
+            offset += movie_utils.probe_container_duration(filename)
+
+            # Remove the video as soon as it is concatenated
+            os.remove(filename)
+            release_disk(video_size)
+
+        concat_process.stdin.close()
+        concat_process.wait()
+    except Exception:
+        stop.set()
+        with disk_cond:
+            disk_cond.notify_all()
+        concat_process.kill()
+        concat_process.wait()
+        raise
+    finally:
+        scheduler.join()
+        pool.close()
+        pool.join()
+        uploader.join()
+
+        # Remove the videos downloaded but not concatenated
+        for download in downloads:
+            if download.ready() and download.successful() and os.path.exists(download.get()):
+                os.remove(download.get())
+
+        # Remove the incomplete concatenated video
+        if concat_process.returncode != 0 and "n_bytes" in upload_result:
+            client.delete_object(Bucket=bucket, Key=key)
+
+    if concat_process.returncode != 0:
+        raise subprocess.CalledProcessError(concat_process.returncode, "ffmpeg")
+    if "error" in upload_result:
+        raise upload_result["error"]
+
+    url = client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=3600
+    )
+    remux_filename = os.path.join(tmp_dir, "concat_remux_" + key.split("/")[-1])
+    try:
+        # Replace the fragmented video with a regular mp4, with its index at the start
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-y",
+                "-i",
+                url,
+                "-map",
+                "0",
+                "-c",
+                "copy",
+                "-movflags",
+                "+faststart",
+                "-f",
+                "mp4",
+                remux_filename,
+            ],
+            check=True,
+        )
+        n_bytes = os.path.getsize(remux_filename)
+        upload_file_to_s3(client, bucket=bucket, key=key, filename=remux_filename)
+
+        # Check the uploaded video can be read and has the duration of all the videos
+        duration = movie_utils.probe_container_duration(url)
+        if abs(duration - offset) > duration_tolerance:
+            raise ValueError(
+                f"The concatenated video lasts {duration:.2f} seconds, "
+                f"the videos concatenated last {offset:.2f} seconds"
+            )
+    except (ValueError, subprocess.CalledProcessError):
+        client.delete_object(Bucket=bucket, Key=key)
+        raise
+    finally:
+        if os.path.exists(remux_filename):
+            os.remove(remux_filename)
+
+    logging.info(f"{len(keys)} videos concatenated and uploaded to {key}")
+    return n_bytes
+
+
 # def retrieve_s3_buckets_info(client, bucket, suffix):
 
 #     # Select the relevant bucket
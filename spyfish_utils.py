@@ -1,6 +1,7 @@
 # base imports
 import os
 import boto3
+import struct
 import logging
 import pandas as pd
 from tqdm import tqdm
@@ -126,7 +127,9 @@ def add_fps_length_spyfish(
     df: pd.DataFrame, miss_par_df: pd.DataFrame, client: boto3.client
 ):
     """
-    It downloads the movie locally, gets the fps and duration, and then deletes the movie
+    It gets the fps and duration of the movies from their moov box (the index of the mp4/mov container),
+    reading it with ranged GETs instead of downloading the movies. The movies that can't be probed this
+    way are downloaded locally, probed and then deleted
 
     :param df: the dataframe containing the movies
     :param miss_par_df: a dataframe containing the movies that are missing fps and duration
@@ -136,6 +139,22 @@ def add_fps_length_spyfish(
 
     # Loop through each movie missing fps and duration
     for index, row in tqdm(miss_par_df.iterrows(), total=miss_par_df.shape[0]):
+        # Read the fps and duration from the moov box of the movie
+        try:
+            file_size = client.head_object(Bucket="marine-buv", Key=row["Key"])[
+                "ContentLength"
+            ]
+            fps, duration = movie_utils.probe_mp4_fps_duration(
+                lambda start, end: server_utils.read_s3_range(
+                    client, bucket="marine-buv", key=row["Key"], start=start, end=end
+                ),
+                file_size,
+            )
+            df.at[index, "fps"], df.at[index, "duration"] = fps, duration
+            continue
+        except (ValueError, struct.error) as e:
+            logging.info(f"{row['filename']} couldn't be probed remotely, {e}")
+
         if not os.path.exists(row["filename"]):
             # Download the movie locally
             server_utils.download_object_from_s3(
@@ -146,7 +165,7 @@ def add_fps_length_spyfish(
             )
 
         # Set the fps and duration of the movie
-        df.at[index, "fps"], df.at[index, "duration"] = movie_utils.get_length(
+        df.at[index, "fps"], df.at[index, "duration"] = movie_utils.get_fps_duration(
             row["filename"]
         )
 
@@ -205,7 +224,13 @@ def process_spyfish_movies(movies_df: pd.DataFrame):
 
 
 # Function to download go pro videos, concatenate them and upload the concatenated videos to aws
-def concatenate_videos(df: pd.DataFrame, session: boto3.Session):
+def concatenate_videos(
+    df: pd.DataFrame,
+    session: boto3.Session,
+    pipelined: bool = False,
+    pool_size: int = 4,
+    disk_budget: int = 20 * 1024 * 1024 * 1024,
+):
     """
     It takes a dataframe with the following columns:
 
@@ -220,6 +245,10 @@ def concatenate_videos(df: pd.DataFrame, session: boto3.Session):
     :param df: the dataframe with the information about the videos to concatenate
     :type df: pd.DataFrame
     :param session: the boto3 session object
+    :param pipelined: download the go pro videos concurrently and stream the concatenated video to S3
+    (see server_utils.concatenate_s3_videos), defaults to False
+    :param pool_size: the max number of videos downloaded at the same time in pipelined mode, defaults to 4
+    :param disk_budget: the max number of bytes the downloaded videos can take in pipelined mode, defaults to 20GB
     """
 
     # Loop through each survey to find out the raw videos recorded with the GoPros
@@ -229,6 +258,17 @@ def concatenate_videos(df: pd.DataFrame, session: boto3.Session):
         list1 = row["go_pro_files"].split(";")
         list_go_pro = [row["prefix"] + "/" + s for s in list1]
 
+        if pipelined:
+            server_utils.concatenate_s3_videos(
+                session,
+                bucket=row["bucket"],
+                keys=list_go_pro,
+                key=row["prefix"] + "/" + row["filename"],
+                pool_size=pool_size,
+                disk_budget=disk_budget,
+            )
+            continue
+
         # Start text file and list to keep track of the videos to concatenate
         textfile_name = "a_file.txt"
         textfile = open(textfile_name, "w")
@@ -354,7 +394,7 @@ def process_spyfish_subjects(subjects: pd.DataFrame, db_path: str):
     subjects["clip_end_time"] = subjects["clip_start_time"] + subjects["#clip_length"]
 
     # Create connection to db
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     ##### Match 'ScientificName' to species id and save as column "frame_exp_sp_id"
     # Query id and sci. names from the species table
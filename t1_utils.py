@@ -374,10 +374,9 @@ def check_movies_csv(
             logging.info("Getting the fps and duration of the movies")
             # Read the movies and overwrite the existing fps and duration info
             df_missing[[col_fps, col_duration]] = pd.DataFrame(
-                [
-                    movie_utils.get_fps_duration(i)
-                    for i in tqdm(df_missing["movie_path"], total=df_missing.shape[0])
-                ],
+                movie_utils.get_movies_fps_duration(
+                    df_missing["movie_path"].tolist(), db_info_dict["db_path"]
+                ),
                 columns=[col_fps, col_duration],
             )
 
@@ -399,25 +398,38 @@ def check_movies_csv(
 
         logging.info("Getting the fps and duration of the movies")
         # Read the movies and overwrite the existing fps and duration info
-        df[[col_fps, col_duration]] = pd.DataFrame(
-            [
-                movie_utils.get_fps_duration(i)
-                for i in tqdm(df["movie_path"], total=df.shape[0])
-            ],
+        probed_df = pd.DataFrame(
+            movie_utils.get_movies_fps_duration(
+                df["movie_path"].tolist(), db_info_dict["db_path"]
+            ),
             columns=[col_fps, col_duration],
+            index=df.index,
         )
 
+        # Keep the existing info of the movies that couldn't be probed
+        probed = probed_df[col_fps].notna()
+        for col in [col_fps, col_duration]:
+            if col not in df.columns:
+                df[col] = np.nan
+        df.loc[probed, [col_fps, col_duration]] = probed_df[probed]
+        if not probed.all():
+            logging.warning(
+                f"The fps and duration of {(~probed).sum()} movies couldn't be probed, "
+                f"their existing info is kept {df.loc[~probed, 'filename'].tolist()}"
+            )
+
         logging.info("Standardising the format, frame rate and codec of the movies")
+        probed_movies = set(df.loc[probed, "movie_path"])
 
         # Convert movies to the right format, frame rate or codec and upload them to the project's server/storage
-        [
-            movie_utils.standarise_movie_format(
-                i, j, k, db_info_dict, project, gpu_available
-            )
-            for i, j, k in tqdm(
-                zip(df["movie_path"], df["filename"], df[col_fpath]), total=df.shape[0]
-            )
-        ]
+        # (skipping the movies that couldn't be reached)
+        movie_utils.transcode_movies(
+            df[df["movie_path"].isin(probed_movies)],
+            db_info_dict,
+            project,
+            gpu_available,
+            col_fpath=col_fpath,
+        )
 
         # Drop unnecessary columns
         df = df.drop(columns=["movie_path"])
@@ -521,7 +533,12 @@ def select_eventdate():
 
 
 def update_new_deployments(
-    deployment_selected: widgets.Widget, db_info_dict: dict, event_date: widgets.Widget
+    deployment_selected: widgets.Widget,
+    db_info_dict: dict,
+    event_date: widgets.Widget,
+    pipelined: bool = False,
+    pool_size: int = 4,
+    disk_budget: int = 20 * 1024 * 1024 * 1024,
 ):
     """
     It takes a deployment, downloads all the movies from that deployment, concatenates them, uploads the
@@ -530,6 +547,10 @@ def update_new_deployments(
     :param deployment_selected: the deployment you want to concatenate
     :param db_info_dict: a dictionary with the following keys:
     :param event_date: the date of the event you want to concatenate
+    :param pipelined: download the movies concurrently and stream the concatenated video to S3
+    (see server_utils.concatenate_s3_videos), defaults to False
+    :param pool_size: the max number of movies downloaded at the same time in pipelined mode, defaults to 4
+    :param disk_budget: the max number of bytes the downloaded movies can take in pipelined mode, defaults to 20GB
     """
     for deployment_i in deployment_selected.value:
         logging.info(
@@ -555,77 +576,90 @@ def update_new_deployments(
             # Concatenate the files if multiple
             logging.info(f"The files {movie_files_server} will be concatenated")
 
-            # Start text file and list to keep track of the videos to concatenate
-            textfile_name = "a_file.txt"
-            textfile = open(textfile_name, "w")
-            video_list = []
-
-            for movie_i in sorted(movie_files_server):
-                # Specify the temporary output of the go pro file
-                movie_i_output = movie_i.split("/")[-1]
-
-                # Download the files from the S3 bucket
-                if not os.path.exists(movie_i_output):
-                    server_utils.download_object_from_s3(
-                        client=db_info_dict["client"],
-                        bucket=db_info_dict["bucket"],
-                        key=movie_i,
-                        filename=movie_i_output,
-                    )
-                # Keep track of the videos to concatenate
-                textfile.write("file '" + movie_i_output + "'" + "\n")
-                video_list.append(movie_i_output)
-            textfile.close()
-
             # Save eventdate as str
             EventDate_str = event_date.value.strftime("%d_%m_%Y")
 
             # Specify the name of the concatenated video
             filename = deployment_i.split("/")[-1] + "_" + EventDate_str + ".MP4"
 
-            # Concatenate the files
-            if not os.path.exists(filename):
-                logging.info("Concatenating ", filename)
-
-                # Concatenate the videos
-                subprocess.call(
-                    [
-                        "ffmpeg",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
-                        "-i",
-                        "a_file.txt",
-                        "-c:a",
-                        "copy",
-                        "-c:v",
-                        "h264",
-                        "-crf",
-                        "22",
-                        filename,
-                    ]
+            if pipelined:
+                # Download, concatenate and upload the files at the same time
+                server_utils.concatenate_s3_videos(
+                    db_info_dict["client"],
+                    bucket=db_info_dict["bucket"],
+                    keys=sorted(movie_files_server),
+                    key=deployment_i + "/" + filename,
+                    codec_args=["-c:a", "copy", "-c:v", "h264", "-crf", "22"],
+                    pool_size=pool_size,
+                    disk_budget=disk_budget,
                 )
 
-            # Upload the concatenated video to the S3
-            server_utils.upload_file_to_s3(
-                db_info_dict["client"],
-                bucket=db_info_dict["bucket"],
-                key=deployment_i + "/" + filename,
-                filename=filename,
-            )
+            else:
+                # Start text file and list to keep track of the videos to concatenate
+                textfile_name = "a_file.txt"
+                textfile = open(textfile_name, "w")
+                video_list = []
+
+                for movie_i in sorted(movie_files_server):
+                    # Specify the temporary output of the go pro file
+                    movie_i_output = movie_i.split("/")[-1]
+
+                    # Download the files from the S3 bucket
+                    if not os.path.exists(movie_i_output):
+                        server_utils.download_object_from_s3(
+                            client=db_info_dict["client"],
+                            bucket=db_info_dict["bucket"],
+                            key=movie_i,
+                            filename=movie_i_output,
+                        )
+                    # Keep track of the videos to concatenate
+                    textfile.write("file '" + movie_i_output + "'" + "\n")
+                    video_list.append(movie_i_output)
+                textfile.close()
+
+                # Concatenate the files
+                if not os.path.exists(filename):
+                    logging.info("Concatenating ", filename)
+
+                    # Concatenate the videos
+                    subprocess.call(
+                        [
+                            "ffmpeg",
+                            "-f",
+                            "concat",
+                            "-safe",
+                            "0",
+                            "-i",
+                            "a_file.txt",
+                            "-c:a",
+                            "copy",
+                            "-c:v",
+                            "h264",
+                            "-crf",
+                            "22",
+                            filename,
+                        ]
+                    )
+
+                # Upload the concatenated video to the S3
+                server_utils.upload_file_to_s3(
+                    db_info_dict["client"],
+                    bucket=db_info_dict["bucket"],
+                    key=deployment_i + "/" + filename,
+                    filename=filename,
+                )
 
-            logging.info(f"{filename} successfully uploaded to {deployment_i}")
+                logging.info(f"{filename} successfully uploaded to {deployment_i}")
 
-            # Delete the raw videos downloaded from the S3 bucket
-            for f in video_list:
-                os.remove(f)
+                # Delete the raw videos downloaded from the S3 bucket
+                for f in video_list:
+                    os.remove(f)
 
-            # Delete the text file
-            os.remove(textfile_name)
+                # Delete the text file
+                os.remove(textfile_name)
 
-            # Delete the concat video
-            os.remove(filename)
+                # Delete the concat video
+                os.remove(filename)
 
             # Delete the movies from the S3 bucket
             for movie_i in sorted(movie_files_server):
@@ -650,7 +684,7 @@ def check_species_csv(db_info_dict: dict, project: project_utils.Project):
     species_df = pd.read_csv(db_info_dict["local_species_csv"])
 
     # Retrieve the names of the basic columns in the sql db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
     data = conn.execute(f"SELECT * FROM species")
     field_names = [i[0] for i in data.description]
 
@@ -9,8 +9,9 @@ import math
 import datetime
 import subprocess
 import logging
+import time
 import random
-import threading
+from functools import partial
 from multiprocessing.pool import ThreadPool as Pool
 
 # widget imports
@@ -26,6 +27,7 @@ from panoptes_client import (
 # util imports
 import kso_utils.db_utils as db_utils
 import kso_utils.project_utils as project_utils
+import kso_utils.movie_utils as movie_utils
 
 # Logging
 logging.basicConfig()
@@ -50,7 +52,7 @@ def check_movie_uploaded(movie_i: str, db_info_dict: dict):
     """
 
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Query info about the clip subjects uploaded to Zooniverse
     subjects_df = pd.read_sql_query(
@@ -103,7 +105,7 @@ def select_random_clips(movie_i: str, db_info_dict: dict):
     :return: A dictionary with the starting points of the clips and the length of the clips.
     """
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Query info about the movie of interest
     movie_df = pd.read_sql_query(
@@ -154,19 +156,44 @@ def select_random_clips(movie_i: str, db_info_dict: dict):
 
 # Function to extract the videos
 def extract_example_clips(
-    output_clip_path: str, start_time_i: int, clip_length: int, movie_path: str
+    output_clip_path: str,
+    start_time_i: int,
+    clip_length: int,
+    movie_path: str,
+    keyframe_tolerance: float = None,
 ):
     """
-    > Extracts a clip from a movie file, and saves it to a new file
+    > Extracts a clip from a movie file, and saves it to a new file. The clip is stream-copied. If
+    keyframe_tolerance is given, it is copied from the keyframe closest to its start time instead
+    (and re-encoded if there isn't a keyframe close enough)
 
     :param output_clip_path: The path to the output clip
     :param start_time_i: The start time of the clip in seconds
     :param clip_length: The length of the clip in seconds
     :param movie_path: the path to the movie file
+    :param keyframe_tolerance: the max number of seconds the start of the clip can be moved to
+    match a keyframe, defaults to None (copy from the start time)
+    :return: the second the clip actually starts at
     """
 
     # Extract the clip
     if not os.path.exists(output_clip_path):
+        keyframe = None
+        if keyframe_tolerance is not None:
+            keyframe = movie_utils.snap_to_keyframe(
+                str(movie_path), start_time_i, keyframe_tolerance
+            )
+
+        if keyframe is not None:
+            # Copy the clip without re-encoding it
+            codec_args = ["-c", "copy", "-avoid_negative_ts", "make_zero"]
+            start_time_i = keyframe
+        elif keyframe_tolerance is None:
+            # Copy the clip from the requested start time
+            codec_args = ["-c", "copy", "-force_key_frames", "1"]
+        else:
+            codec_args = ["-crf", "20", "-pix_fmt", "yuv420p", "-c:v", "libx264"]
+
         subprocess.call(
             [
                 "ffmpeg",
@@ -176,17 +203,16 @@ def extract_example_clips(
                 str(clip_length),
                 "-i",
                 str(movie_path),
-                "-c",
-                "copy",
+                *codec_args,
                 "-an",  # removes the audio
-                "-force_key_frames",
-                "1",
                 str(output_clip_path),
             ]
         )
 
         os.chmod(output_clip_path, 0o777)
 
+    return start_time_i
+
 
 def create_example_clips(
     movie_i: str,
@@ -195,6 +221,7 @@ def create_example_clips(
     project: project_utils.Project,
     clip_selection,
     pool_size=4,
+    keyframe_tolerance: float = None,
 ):
     """
     This function takes a movie and extracts clips from it, based on the start time and length of the
@@ -209,6 +236,8 @@ def create_example_clips(
     :param project: the project object
     :param clip_selection: a dictionary with the following keys:
     :param pool_size: The number of parallel processes to run, defaults to 4 (optional)
+    :param keyframe_tolerance: the max number of seconds the start of the clips can be moved to match
+    a keyframe (see extract_example_clips), defaults to None (optional)
     :return: The path of the clips
     """
 
@@ -233,6 +262,10 @@ def create_example_clips(
         os.mkdir(clips_folder)
         os.chmod(clips_folder, 0o777)
 
+    # Probe the keyframes of the movie once for all the clips
+    if keyframe_tolerance is not None:
+        movie_utils.get_keyframes(str(movie_path), db_info_dict.get("db_path"))
+
     # Specify the number of parallel items
     pool = Pool(pool_size)
 
@@ -258,6 +291,7 @@ def create_example_clips(
                 start_time_i,
                 clip_length,
                 movie_path,
+                keyframe_tolerance,
             ),
         )
 
@@ -628,7 +662,7 @@ def select_clip_n_len(movie_i: str, db_info_dict: dict):
     """
 
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Query info about the movie of interest
     movie_df = pd.read_sql_query(
@@ -715,6 +749,9 @@ def extract_clips(
     output_clip_path: str,
     modification_details: dict,
     gpu_available: bool,
+    timeout: int = None,
+    threads: int = None,
+    keyframe_tolerance: float = None,
 ):
     """
     This function takes in a movie path, a clip length, a starting second index, an output clip path, a
@@ -733,10 +770,48 @@ def extract_clips(
     modifications, and the values are dictionaries containing the details of the modification. The
     details of the modification are:
     :param gpu_available: If you have a GPU, set this to True. If you don't, set it to False
+    :param timeout: the number of seconds after which ffmpeg is killed, defaults to no limit
+    :param threads: the number of threads ffmpeg can use, defaults to ffmpeg's choice
+    :param keyframe_tolerance: the max number of seconds the start of an unmodified clip can be
+    moved to match a keyframe and copy it without re-encoding, defaults to None (always re-encode)
+    :return: the second the clip actually starts at, which differs from upl_second_i if it was
+    moved to a keyframe
     """
-    if not modification_details and gpu_available:
+    # Limit the threads used by ffmpeg
+    threads_args = ["-threads", str(threads)] if threads else []
+
+    # Check if the clip can be copied from a keyframe
+    keyframe = None
+    if not modification_details and keyframe_tolerance is not None:
+        keyframe = movie_utils.snap_to_keyframe(
+            movie_path, upl_second_i, keyframe_tolerance
+        )
+
+    if keyframe is not None:
+        # Copy the clip without re-encoding it
+        subprocess.check_call(
+            [
+                "ffmpeg",
+                "-ss",
+                str(keyframe),
+                "-t",
+                str(clip_length),
+                "-i",
+                movie_path,
+                "-an",  # removes the audio
+                "-c:v",
+                "copy",
+                "-avoid_negative_ts",
+                "make_zero",
+                str(output_clip_path),
+            ],
+            timeout=timeout,
+        )
+        os.chmod(str(output_clip_path), 0o777)
+
+    elif not modification_details and gpu_available:
         # Create clips without any modification
-        subprocess.call(
+        subprocess.check_call(
             [
                 "ffmpeg",
                 "-hwaccel",
@@ -754,8 +829,10 @@ def extract_clips(
                 "copy",
                 "-c:v",
                 "h264_nvenc",
+                *threads_args,
                 str(output_clip_path),
-            ]
+            ],
+            timeout=timeout,
         )
         os.chmod(str(output_clip_path), 0o777)
 
@@ -765,7 +842,7 @@ def extract_clips(
         df = pd.json_normalize(modification_details, sep="_")
         b_v = df.filter(regex="bv$", axis=1).values[0][0] + "M"
 
-        subprocess.call(
+        subprocess.check_call(
             [
                 "ffmpeg",
                 "-hwaccel",
@@ -785,8 +862,10 @@ def extract_clips(
                 "h264_nvenc",
                 "-b:v",
                 b_v,
+                *threads_args,
                 str(output_clip_path),
-            ]
+            ],
+            timeout=timeout,
         )
         os.chmod(str(output_clip_path), 0o777)
     else:
@@ -794,7 +873,9 @@ def extract_clips(
         init_prompt = f"ffmpeg_python.input('{movie_path}')"
         full_prompt = init_prompt
         mod_prompt = ''
-        def_output_prompt = f".output('{str(output_clip_path)}', ss={str(upl_second_i)}, t={str(clip_length)}, crf=20, pix_fmt='yuv420p', vcodec='libx264')"
+        output_prompt = ''
+        threads_prompt = f", threads={threads}" if threads else ""
+        def_output_prompt = f".output('{str(output_clip_path)}', ss={str(upl_second_i)}, t={str(clip_length)}, crf=20, pix_fmt='yuv420p', vcodec='libx264'{threads_prompt})"
 
         # Set up modification
         for transform in modification_details.values():
@@ -805,7 +886,7 @@ def extract_clips(
                 # Unnest the modification detail dict
                 df = pd.json_normalize(modification_details, sep="_")
                 crf = df.filter(regex="crf$", axis=1).values[0][0]
-                output_prompt = f".output('{str(output_clip_path)}', crf={crf}, ss={str(upl_second_i)}, t={str(clip_length)}, preset='veryfast', pix_fmt='yuv420p', vcodec='libx264')"
+                output_prompt = f".output('{str(output_clip_path)}', crf={crf}, ss={str(upl_second_i)}, t={str(clip_length)}, preset='veryfast', pix_fmt='yuv420p', vcodec='libx264'{threads_prompt})"
 
         # Run the modification
         try:
@@ -815,7 +896,15 @@ def extract_clips(
                 full_prompt += output_prompt
             else:
                 full_prompt += def_output_prompt
-            eval(full_prompt).run(capture_stdout=True, capture_stderr=True)
+            process = eval(full_prompt).run_async(pipe_stdout=True, pipe_stderr=True)
+            try:
+                out, err = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise
+            if process.returncode != 0:
+                raise ffmpeg_python.Error("ffmpeg", out, err)
             os.chmod(str(output_clip_path), 0o777)
         except ffmpeg_python.Error as e:
             logging.info("stdout:", e.stdout.decode("utf8"))
@@ -824,6 +913,131 @@ def extract_clips(
 
         logging.info("Clips extracted successfully")
 
+    return upl_second_i if keyframe is None else keyframe
+
+
+def extract_clips_single_pass(
+    movie_path: str,
+    clip_length: int,
+    upl_seconds: list,
+    output_clip_paths: list,
+    modification_details: dict,
+):
+    """
+    This function cuts all the clips of a movie in a single decode pass with ffmpeg's segment muxer,
+    instead of running one ffmpeg process (and seek) per clip. Keyframes are forced at the start of
+    each clip so every segment is a standalone clip, encoded with the same settings as the cpu path
+    of extract_clips. The clips must be consecutive (each one starting where the previous one ends).
+
+    :param movie_path: The path to the movie file
+    :param clip_length: The length of the clips in seconds
+    :param upl_seconds: The seconds in the video where the clips start, in order
+    :param output_clip_paths: The paths to the output clips, in the same order
+    :param modification_details: a dictionary of dictionaries with the modifications to apply to
+    the clips (see extract_clips)
+    """
+    # Write the segments to a temporary folder next to the clips
+    segments_folder = os.path.join(
+        os.path.dirname(str(output_clip_paths[0])), "single_pass_segments"
+    )
+    if os.path.exists(segments_folder):
+        shutil.rmtree(segments_folder)
+    os.mkdir(segments_folder)
+
+    # Set up input prompt
+    init_prompt = f"ffmpeg_python.input('{movie_path}', ss={str(upl_seconds[0])}, t={str(clip_length * len(upl_seconds))})"
+    mod_prompt = ""
+    output_kwargs = {"crf": 20}
+
+    # Set up modification
+    for transform in modification_details.values():
+        if "filter" in transform:
+            mod_prompt += transform["filter"]
+
+        else:
+            # Unnest the modification detail dict
+            df = pd.json_normalize(modification_details, sep="_")
+            crf = df.filter(regex="crf$", axis=1).values[0][0]
+            output_kwargs = {"crf": crf, "preset": "veryfast"}
+
+    # Run the modification
+    try:
+        eval(init_prompt + mod_prompt).output(
+            os.path.join(segments_folder, "segment_%05d.mp4"),
+            f="segment",
+            segment_time=clip_length,
+            reset_timestamps=1,
+            force_key_frames=f"expr:gte(t,n_forced*{clip_length})",
+            pix_fmt="yuv420p",
+            vcodec="libx264",
+            **output_kwargs,
+        ).run(capture_stdout=True, capture_stderr=True)
+    except ffmpeg_python.Error as e:
+        logging.info("stdout:", e.stdout.decode("utf8"))
+        logging.info("stderr:", e.stderr.decode("utf8"))
+        raise e
+
+    # Give the segments the names of the clips
+    for i, output_clip_path in enumerate(output_clip_paths):
+        segment_path = os.path.join(segments_folder, f"segment_{i:05d}.mp4")
+        if os.path.exists(segment_path):
+            shutil.move(segment_path, str(output_clip_path))
+            os.chmod(str(output_clip_path), 0o777)
+        else:
+            logging.error(f"The clip {output_clip_path} could not be extracted")
+
+    shutil.rmtree(segments_folder)
+
+    logging.info("Clips extracted successfully")
+
+
+def extract_clip_job(
+    job: tuple,
+    timeout: int = None,
+    retries: int = 1,
+    threads: int = None,
+    keyframe_tolerance: float = None,
+):
+    """
+    > This function runs extract_clips for one clip of the work queue of create_clips. The clips
+    that fail or run longer than the timeout are removed and extracted again, up to retries times
+
+    :param job: a tuple with the movie_path, clip_length, upl_second_i, output_clip_path,
+    modification_details and gpu_available arguments of extract_clips
+    :param timeout: the number of seconds after which an attempt is stopped, defaults to no limit
+    :param retries: the number of times a failed clip is extracted again, defaults to 1
+    :param threads: the number of threads ffmpeg can use, defaults to ffmpeg's choice
+    :param keyframe_tolerance: the max number of seconds the start of an unmodified clip can be
+    moved to copy it from a keyframe, defaults to None (always re-encode)
+    :return: a tuple with the path to the clip, the seconds it took to extract it, whether it was
+    extracted and the second the clip actually starts at
+    """
+    output_clip_path = job[3]
+    start_time = time.perf_counter()
+
+    for attempt in range(retries + 1):
+        try:
+            clip_start = extract_clips(
+                *job,
+                timeout=timeout,
+                threads=threads,
+                keyframe_tolerance=keyframe_tolerance,
+            )
+            return output_clip_path, time.perf_counter() - start_time, True, clip_start
+        except (
+            subprocess.TimeoutExpired,
+            subprocess.CalledProcessError,
+            ffmpeg_python.Error,
+        ) as e:
+            logging.warning(
+                f"Attempt {attempt + 1} to extract {output_clip_path} failed, {e}"
+            )
+            # Remove the incomplete clip
+            if os.path.exists(str(output_clip_path)):
+                os.remove(str(output_clip_path))
+
+    return output_clip_path, time.perf_counter() - start_time, False, job[2]
+
 
 def create_clips(
     available_movies_df: pd.DataFrame,
@@ -834,7 +1048,12 @@ def create_clips(
     project: project_utils.Project,
     modification_details: dict,
     gpu_available: bool,
-    pool_size: int = 4,
+    pool_size: int = None,
+    single_pass: bool = False,
+    ffmpeg_threads: int = 2,
+    clip_timeout: int = None,
+    clip_retries: int = 1,
+    keyframe_tolerance: float = None,
 ):
     """
     This function takes a movie and extracts clips from it
@@ -847,7 +1066,18 @@ def create_clips(
     :param project: the project object
     :param modification_details: a dictionary with the following keys:
     :param gpu_available: True or False, depending on whether you have a GPU available to use
-    :param pool_size: the number of threads to use to extract the clips, defaults to 4 (optional)
+    :param pool_size: the number of clips extracted at the same time, defaults to the number of
+    cpus divided by ffmpeg_threads (optional)
+    :param single_pass: cut all the clips in a single ffmpeg pass over the movie (cpu only),
+    defaults to False (optional)
+    :param ffmpeg_threads: the number of threads each ffmpeg process can use, defaults to 2 (optional)
+    :param clip_timeout: the number of seconds after which the extraction of a clip is stopped,
+    defaults to no limit (optional)
+    :param clip_retries: the number of times a failed clip is extracted again, defaults to 1 (optional)
+    :param keyframe_tolerance: the max number of seconds the start of unmodified clips can be moved
+    to copy them from a keyframe instead of re-encoding them. The clips moved are renamed and their
+    upl_seconds updated to the keyframe, so consecutive clips can overlap or leave gaps of up to
+    keyframe_tolerance seconds. Defaults to None, always re-encode (optional)
     :return: A dataframe with the clip_path, clip_filename, clip_length, upl_seconds, and
     clip_modification_details
     """
@@ -923,31 +1153,111 @@ def create_clips(
 
     logging.info("Extracting clips")
 
-    for i in range(0, potential_start_df.shape[0], pool_size):
-        logging.info(
-            f"Modifying {i} to {i+pool_size} out of {potential_start_df.shape[0]}"
+    # Check the clips are consecutive, so they can be cut in a single pass
+    consecutive_clips = (
+        np.diff(potential_start_df["upl_seconds"].values) == clip_length
+    ).all()
+
+    if (
+        single_pass
+        and not gpu_available
+        and consecutive_clips
+        and len(potential_start_df)
+    ):
+        extract_clips_single_pass(
+            movie_path,
+            clip_length,
+            potential_start_df["upl_seconds"].tolist(),
+            potential_start_df["clip_path"].tolist(),
+            modification_details,
         )
 
-        threadlist = []
-        # Read each movie and extract the clips
-        for index, row in potential_start_df.iloc[i : i + pool_size].iterrows():
-            # Extract the videos and store them in the folder
-            t = threading.Thread(
-                target=extract_clips,
-                args=(
-                    movie_path,
-                    clip_length,
-                    row["upl_seconds"],
-                    row["clip_path"],
-                    modification_details,
-                    gpu_available,
-                ),
+    else:
+        # Keep the cpus busy without oversubscribing them with ffmpeg threads
+        if pool_size is None:
+            pool_size = max(1, (os.cpu_count() or 1) // ffmpeg_threads)
+
+        # Probe the keyframes of the movie once for all the unmodified clips
+        if not modification_details and keyframe_tolerance is not None:
+            movie_utils.get_keyframes(movie_path, db_info_dict.get("db_path"))
+
+        jobs = [
+            (
+                movie_path,
+                clip_length,
+                row["upl_seconds"],
+                row["clip_path"],
+                modification_details,
+                gpu_available,
             )
-            threadlist.append(t)
-            t.start()
+            for _, row in potential_start_df.iterrows()
+        ]
 
-        for tr in threadlist:
-            tr.join()
+        # Extract the clips from a queue, starting a new clip as soon as one finishes
+        clip_times = {}
+        clip_starts = {}
+        failed_clips = []
+        with Pool(pool_size) as pool:
+            for clip_path, clip_time, extracted, clip_start in tqdm(
+                pool.imap_unordered(
+                    partial(
+                        extract_clip_job,
+                        timeout=clip_timeout,
+                        retries=clip_retries,
+                        threads=ffmpeg_threads,
+                        keyframe_tolerance=keyframe_tolerance,
+                    ),
+                    jobs,
+                ),
+                total=len(jobs),
+            ):
+                clip_times[clip_path] = clip_time
+                clip_starts[clip_path] = clip_start
+                logging.debug(f"{clip_path} extracted in {clip_time:.1f} seconds")
+                if not extracted:
+                    failed_clips.append(clip_path)
+
+        if clip_times:
+            logging.info(
+                f"Extracted {len(clip_times) - len(failed_clips)} clips with {pool_size} workers,"
+                f" {np.mean(list(clip_times.values())):.1f} seconds per clip on average"
+                f" (slowest {max(clip_times.values()):.1f} seconds)"
+            )
+        if failed_clips:
+            logging.error(f"The following clips could not be extracted {failed_clips}")
+
+        # Update the start (and name) of the clips moved to a keyframe
+        clip_start = potential_start_df["clip_path"].map(clip_starts)
+        moved = clip_start.notnull() & (clip_start != potential_start_df["upl_seconds"])
+        if moved.any():
+            logging.info(f"The start of {moved.sum()} clips was moved to a keyframe")
+            potential_start_df["upl_seconds"] = potential_start_df[
+                "upl_seconds"
+            ].astype(object)
+            for i in potential_start_df.index[moved]:
+                upl_second = round(float(clip_start[i]), 3)
+                clip_filename = (
+                    movie_i
+                    + "_clip_"
+                    + str(upl_second)
+                    + "_"
+                    + str(clip_length)
+                    + ".mp4"
+                )
+                clip_path = clips_folder + os.sep + clip_filename
+                if os.path.exists(potential_start_df.at[i, "clip_path"]):
+                    os.rename(potential_start_df.at[i, "clip_path"], clip_path)
+                potential_start_df.at[i, "upl_seconds"] = upl_second
+                potential_start_df.at[i, "clip_filename"] = clip_filename
+                potential_start_df.at[i, "clip_path"] = clip_path
+
+    # Drop the clips that couldn't be extracted, so they aren't uploaded
+    extracted = potential_start_df["clip_path"].apply(os.path.exists)
+    if not extracted.all():
+        logging.error(
+            f"{(~extracted).sum()} clips couldn't be extracted and won't be uploaded"
+        )
+        potential_start_df = potential_start_df[extracted].reset_index(drop=True)
 
     # Add information on the modification of the clips
     potential_start_df["clip_modification_details"] = str(modification_details)
@@ -968,7 +1278,7 @@ def set_zoo_metadata(
     """
 
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Query info about the movie of interest
     sitesdf = pd.read_sql_query("SELECT * FROM sites", conn)
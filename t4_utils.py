@@ -10,6 +10,7 @@ import numpy as np
 import shutil
 import logging
 import cv2
+from multiprocessing import Pool
 
 # widget imports
 from tqdm import tqdm
@@ -46,7 +47,7 @@ def choose_species(db_info_dict: dict):
     :type db_info_dict: dict
     """
     # Create connection to db
-    conn = db_utils.create_connection(db_info_dict["db_path"])
+    conn = db_utils.get_connection(db_info_dict["db_path"], read_only=True)
 
     # Get a list of the species available
     species_list = pd.read_sql_query("SELECT label from species", conn)[
@@ -93,7 +94,7 @@ def get_species_ids(project: project_utils.Project, species_list: list):
     # Get ids of species of interest
     """
     db_path = project.db_path
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
     if len(species_list) == 1:
         species_ids = pd.read_sql_query(
             f'SELECT id FROM species WHERE label=="{species_list[0]}"', conn
@@ -305,32 +306,70 @@ def check_frames_uploaded(
     return frames_df
 
 
-def write_movie_frames(key_movie_df: pd.DataFrame, url: str):
+def write_movie_frames(
+    key_movie_df: pd.DataFrame,
+    url: str,
+    max_grab_gap: int = 300,
+    show_progress: bool = True,
+):
     """
-    Function to get a frame from a movie
+    Function to get the frames of interest from a movie. The frames are read in the order they
+    appear in the movie, decoding forward through the gaps between them. The movie is only seeked
+    when the gap is longer than max_grab_gap frames, as each seek decodes again from the previous
+    keyframe
+
+    :param key_movie_df: a dataframe with the frame_number and frame_path of the frames to extract
+    :param url: the path or url of the movie
+    :param max_grab_gap: the longest gap (in frames) decoded forward instead of seeking
+    :param show_progress: display a progress bar of the frames extracted
+    :return: the number of frames requested from the movie
     """
     # Read the movie on cv2 and prepare to extract frames
     cap = cv2.VideoCapture(url)
 
     if cap.isOpened():
-        # Get the frame numbers for each movie the fps and duration
-        for index, row in tqdm(key_movie_df.iterrows(), total=key_movie_df.shape[0]):
-            # Create the folder to store the frames if not exist
-            if not os.path.exists(row["frame_path"]):
-                cap.set(1, row["frame_number"])
-                ret, frame = cap.read()
+        # Select the frames that have not been extracted yet, sorted by frame number
+        key_movie_df = key_movie_df[~key_movie_df["frame_path"].apply(os.path.exists)]
+        frame_groups = key_movie_df.groupby("frame_number", sort=True)
+
+        # Keep track of the position of the decoder
+        position = 0
+
+        for frame_number, frame_df in tqdm(
+            frame_groups, total=frame_groups.ngroups, disable=not show_progress
+        ):
+            frame_number = int(frame_number)
+            gap = frame_number - position
+
+            # Seek far frames, decode forward (without retrieving) to the close ones
+            if gap < 0 or gap > max_grab_gap:
+                cap.set(1, frame_number)
+            else:
+                for _ in range(gap):
+                    cap.grab()
+
+            ret, frame = cap.read()
+            position = frame_number + 1
+
+            # Save the frame for each row that requested it
+            for frame_path in frame_df["frame_path"]:
                 if frame is not None:
-                    cv2.imwrite(row["frame_path"], frame)
-                    os.chmod(row["frame_path"], 0o777)
+                    cv2.imwrite(frame_path, frame)
+                    os.chmod(frame_path, 0o777)
                 else:
-                    cv2.imwrite(row["frame_path"], np.zeros((100, 100, 3), np.uint8))
-                    os.chmod(row["frame_path"], 0o777)
+                    cv2.imwrite(frame_path, np.zeros((100, 100, 3), np.uint8))
+                    os.chmod(frame_path, 0o777)
                     logging.info(
-                        f"No frame was extracted for {url} at frame {row['frame_number']}"
+                        f"No frame was extracted for {url} at frame {frame_number}"
                     )
     else:
         logging.info("Missing movie", url)
 
+    # Release the decoder before returning (e.g. to the worker pool)
+    cap.release()
+
+    return len(key_movie_df)
+
 
 # Function to extract selected frames from videos
 def extract_frames(
@@ -338,9 +377,20 @@ def extract_frames(
     df: pd.DataFrame,
     server_dict: dict,
     frames_folder: str,
+    pool_size: int = 4,
+    movies_per_worker: int = 10,
 ):
     """
-    Extract frames and save them in chosen folder.
+    Extract frames and save them in chosen folder. The frames of several movies are extracted at
+    the same time, each movie decoded once (with its own capture) by one of the worker processes.
+
+    :param project: the project object
+    :param df: a dataframe with the frames to extract
+    :param server_dict: a dictionary with the server information
+    :param frames_folder: the folder to save the frames in
+    :param pool_size: the number of movies decoded in parallel, defaults to 4 (optional)
+    :param movies_per_worker: the number of movies each worker process decodes before it is
+    replaced by a new one, to release the memory held by the decoders, defaults to 10 (optional)
     """
     # Extract server info
     project_name = project.Project_name
@@ -361,19 +411,37 @@ def extract_frames(
         os.mkdir(frames_folder)
         os.chmod(frames_folder, 0o777)
 
-    for movie in df["fpath"].unique():
-        url = movie_utils.get_movie_path(project=project, db_info_dict=server_dict, f_path=movie)
+    # Specify the number of parallel movies, the workers are terminated if anything fails
+    with Pool(pool_size, maxtasksperchild=movies_per_worker) as pool, tqdm(
+        total=df.shape[0]
+    ) as pbar:
+        for movie in df["fpath"].unique():
+            url = movie_utils.get_movie_path(
+                project=project, db_info_dict=server_dict, f_path=movie
+            )
 
-        if url is None:
-            logging.error(f"Movie {movie} couldn't be found in the server.")
-        else:
             # Select the frames to download from the movie
             key_movie_df = df[df["fpath"] == movie].reset_index()
 
-            # Read the movie on cv2 and prepare to extract frames
-            write_movie_frames(key_movie_df, url)
+            if url is None:
+                logging.error(f"Movie {movie} couldn't be found in the server.")
+                pbar.update(key_movie_df.shape[0])
+            else:
+                # Read the movie on cv2 and extract the frames in a worker
+                pool.apply_async(
+                    write_movie_frames,
+                    (key_movie_df[["frame_number", "frame_path"]], url),
+                    {"show_progress": False},
+                    callback=lambda _, n=key_movie_df.shape[0]: pbar.update(n),
+                    error_callback=lambda e, movie=movie: logging.error(
+                        f"Frames of {movie} couldn't be extracted, {e}"
+                    ),
+                )
+
+        pool.close()
+        pool.join()
 
-        logging.info("Frames extracted successfully")
+    logging.info("Frames extracted successfully")
 
     return df
 
@@ -403,7 +471,7 @@ def get_frames(
         project=project, db_info_dict=server_dict
     )
 
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     if project.movie_folder is None:
 
@@ -736,7 +804,7 @@ def set_zoo_metadata(
 
     # Set project-specific metadata
     if project_name == "Koster_Seafloor_Obs":
-        conn = db_utils.create_connection(project.db_path)
+        conn = db_utils.get_connection(project.db_path, read_only=True)
         sites_df = pd.read_sql_query("SELECT id, siteName FROM sites", conn)
         df = df.merge(sites_df, left_on="site_id", right_on="id")
         upload_to_zoo = df[
@@ -149,7 +149,7 @@ def choose_classes(db_path: str = "koster_lab.db"):
     :type db_path: str (optional)
     :return: A widget object
     """
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
     species_list = pd.read_sql_query("SELECT label from species", conn)[
         "label"
     ].tolist()
@@ -8,9 +8,13 @@ import json
 import logging
 from io import BytesIO
 from base64 import b64encode
+from functools import partial
+from multiprocessing import Pool
 
 # module imports
+from panoptes_client import Project
 import kso_utils.db_utils as db_utils
+import kso_utils.zooniverse_utils as zooniverse_utils
 from kso_utils.koster_utils import filter_bboxes, process_clips_koster
 from kso_utils.spyfish_utils import process_clips_spyfish
 import kso_utils.tutorials_utils as tutorials_utils
@@ -24,6 +28,12 @@ from PIL import Image as PILImage, ImageDraw
 import imagesize
 from jupyter_bbox_widget import BBoxWidget
 
+# Use a faster json parser to load the annotations if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 # Logging
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
@@ -282,6 +292,7 @@ def get_classifications(
     class_df: pd.DataFrame,
     db_path: str,
     project: project_utils.Project,
+    zoo_project: Project = None,
 ):
     """
     It takes in a dictionary of workflows, a dataframe of workflows, the type of subject (frame or
@@ -295,9 +306,11 @@ def get_classifications(
     :param workflows_df: the dataframe of workflows from the Zooniverse project
     :type workflows_df: pd.DataFrame
     :param subj_type: "frame" or "clip"
-    :param class_df: the dataframe of classifications from the database
+    :param class_df: the dataframe of classifications from the database, if None the classifications
+    export is streamed from zoo_project keeping only the workflows of interest
     :param db_path: the path to the database file
     :param project: the name of the project on Zooniverse
+    :param zoo_project: the Zooniverse project object, only needed if class_df is None
     :return: A dataframe with the classifications for the specified project and workflow.
     """
 
@@ -309,17 +322,22 @@ def get_classifications(
     workflow_ids = get_workflow_ids(workflows_df, names)
 
     # Filter classifications of interest
-    classes = []
-    for id, version in zip(workflow_ids, workflow_versions):
-        class_df = class_df[
-            (class_df.workflow_id == id) & (class_df.workflow_version >= version)
-        ].reset_index(drop=True)
-        classes.append(class_df)
-    classes_df = pd.concat(classes)
+    if class_df is None:
+        classes_df = zooniverse_utils.stream_classifications(
+            project, zoo_project, workflow_ids, workflow_versions
+        )
+    else:
+        classes = []
+        for id, version in zip(workflow_ids, workflow_versions):
+            class_df = class_df[
+                (class_df.workflow_id == id) & (class_df.workflow_version >= version)
+            ].reset_index(drop=True)
+            classes.append(class_df)
+        classes_df = pd.concat(classes)
 
     # Add information about the subject
     # Create connection to db
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     if subj_type == "frame":
         # Query id and subject type from the subjects table
@@ -416,8 +434,51 @@ def aggregrate_labels(raw_class_df: pd.DataFrame, agg_users: float, min_users: i
     return agg_class_df
 
 
+def filter_bboxes_groups(groups: list, obj: float, eps: float, iua: float):
+    """
+    > This function runs filter_bboxes on a chunk of annotation groups and returns the rows of the
+    bounding boxes accepted by consensus. It is run in the worker processes of
+    aggregrate_classifications
+
+    :param groups: a list of (label, start_frame, total_users, users, subject_ids, bboxes) tuples
+    :param obj: the minimum fraction of users who must have seen an object
+    :param eps: the maximum IoU distance between two boxes of the same cluster
+    :param iua: the minimum fraction of users who must agree on a bounding box
+    :return: a list of (label, start_frame, subject_id, x, y, w, h) tuples
+    """
+    new_rows = []
+
+    for label, start_frame, total_users, users, subject_ids, bboxes in groups:
+        # Filter bboxes using IOU metric (essentially a consensus metric)
+        # Keep only bboxes where mean overlap exceeds this threshold
+        indices, new_group = filter_bboxes(
+            total_users=total_users,
+            users=users,
+            bboxes=bboxes,
+            obj=obj,
+            eps=eps,
+            iua=iua,
+        )
+
+        for ix, box in zip(subject_ids[indices], new_group):
+            new_rows.append(
+                (
+                    label,
+                    start_frame,
+                    ix,
+                )
+                + tuple(box)
+            )
+
+    return new_rows
+
+
 def aggregrate_classifications(
-    df: pd.DataFrame, subj_type: str, project: project_utils.Project, agg_params
+    df: pd.DataFrame,
+    subj_type: str,
+    project: project_utils.Project,
+    agg_params,
+    pool_size: int = 4,
 ):
     """
     We take the raw classifications and process them to get the aggregated labels
@@ -426,6 +487,8 @@ def aggregrate_classifications(
     :param subj_type: the type of subject, either "frame" or "clip"
     :param project: the project object
     :param agg_params: list of parameters for the aggregation
+    :param pool_size: the number of processes used to filter the bounding boxes of frames,
+    defaults to 4 (optional)
     :return: the aggregated classifications and the raw classifications.
     """
 
@@ -485,66 +548,52 @@ def aggregrate_classifications(
         # Temporary exclude frames aggregrated as empty
         agg_labels_df = agg_labels_df[agg_labels_df["label"] != "empty"]
 
-        # Map the position of the annotation parameters
-        col_list = list(agg_labels_df.columns)
-        x_pos, y_pos, w_pos, h_pos, user_pos, subject_id_pos = (
-            col_list.index("x"),
-            col_list.index("y"),
-            col_list.index("w"),
-            col_list.index("h"),
-            col_list.index("user_name"),
-            col_list.index("subject_ids"),
-        )
-
-        # Get prepared annotations
-        new_rows = []
-
         if agg_labels_df["frame_number"].isnull().all():
             group_cols = ["subject_ids", "label"]
         else:
             group_cols = ["subject_ids", "label", "frame_number"]
 
-        for name, group in agg_labels_df.groupby(group_cols):
+        # Count the users that annotated each group in one go
+        grouped = agg_labels_df.groupby(group_cols)
+        total_users = grouped["user_name"].nunique()
+
+        # Prepare the annotations of each group
+        groups = []
+        for name, group in grouped:
             if "frame_number" in group_cols:
                 subj_id, label, start_frame = name
-                total_users = agg_labels_df[
-                    (agg_labels_df.subject_ids == subj_id)
-                    & (agg_labels_df.label == label)
-                    & (agg_labels_df.frame_number == start_frame)
-                ]["user_name"].nunique()
             else:
                 subj_id, label = name
                 start_frame = np.nan
-                total_users = agg_labels_df[
-                    (agg_labels_df.subject_ids == subj_id)
-                    & (agg_labels_df.label == label)
-                ]["user_name"].nunique()
-
-            # Filter bboxes using IOU metric (essentially a consensus metric)
-            # Keep only bboxes where mean overlap exceeds this threshold
-            indices, new_group = filter_bboxes(
-                total_users=total_users,
-                users=[i[user_pos] for i in group.values],
-                bboxes=[
-                    np.array([i[x_pos], i[y_pos], i[w_pos], i[h_pos]])
-                    for i in group.values
-                ],
-                obj=agg_obj,
-                eps=agg_iou,
-                iua=agg_iua,
+
+            groups.append(
+                (
+                    label,
+                    start_frame,
+                    total_users[name],
+                    group["user_name"].tolist(),
+                    group["subject_ids"].values,
+                    list(group[["x", "y", "w", "h"]].values),
+                )
             )
 
-            subject_ids = [i[subject_id_pos] for i in group.values[indices]]
+        # Split the groups in chunks of at least 100 groups, a few per process
+        n_chunks = max(1, min(len(groups) // 100, pool_size * 4))
+        chunk_len = max(1, -(-len(groups) // n_chunks))
+        chunks = [groups[i : i + chunk_len] for i in range(0, len(groups), chunk_len)]
 
-            for ix, box in zip(subject_ids, new_group):
-                new_rows.append(
-                    (
-                        label,
-                        start_frame,
-                        ix,
-                    )
-                    + tuple(box)
-                )
+        # Filter the bboxes of each chunk, in parallel if there are several chunks
+        filter_chunk = partial(
+            filter_bboxes_groups, obj=agg_obj, eps=agg_iou, iua=agg_iua
+        )
+        if pool_size > 1 and len(chunks) > 1:
+            with Pool(pool_size) as pool:
+                chunk_rows = list(pool.imap(filter_chunk, chunks))
+        else:
+            chunk_rows = list(map(filter_chunk, chunks))
+
+        # Get prepared annotations
+        new_rows = [row for rows in chunk_rows for row in rows]
 
         agg_class_df = pd.DataFrame(
             new_rows,
@@ -630,25 +679,26 @@ def process_clips(df: pd.DataFrame, project: project_utils.Project):
     subject_type, and subject_ids.
     """
 
-    # Create an empty list
-    rows_list = []
+    # Create an empty list and the position of the classification of each annotation
+    rows_list, positions = [], []
 
     # Loop through each classification submitted by the users
-    for index, row in df.iterrows():
+    for pos, (class_id, annotations) in enumerate(
+        zip(df["classification_id"].values, df["annotations"].values)
+    ):
         # Load annotations as json format
-        annotations = json.loads(row["annotations"])
+        annotations = json_loads(annotations)
+        n_rows = len(rows_list)
 
         # Select the information from the species identification task
         if project.Project_name == "Koster_Seafloor_Obs":
-            rows_list = process_clips_koster(
-                annotations, row["classification_id"], rows_list
-            )
+            rows_list = process_clips_koster(annotations, class_id, rows_list)
 
         # Check if the Zooniverse project is the Spyfish
         if project.Project_name == "Spyfish_Aotearoa":
-            rows_list = process_clips_spyfish(
-                annotations, row["classification_id"], rows_list
-            )
+            rows_list = process_clips_spyfish(annotations, class_id, rows_list)
+
+        positions.extend([pos] * (len(rows_list) - n_rows))
 
     # Create a data frame with annotations as rows
     annot_df = pd.DataFrame(
@@ -659,13 +709,9 @@ def process_clips(df: pd.DataFrame, project: project_utils.Project):
     annot_df["how_many"] = pd.to_numeric(annot_df["how_many"])
     annot_df["first_seen"] = pd.to_numeric(annot_df["first_seen"])
 
-    # Add subject id to each annotation
-    annot_df = pd.merge(
-        annot_df,
-        df.drop(columns=["annotations"]),
-        how="left",
-        on="classification_id",
-    )
+    # Add subject id to each annotation from the position of its classification
+    subject_info = df.iloc[positions][["https_location", "subject_type", "subject_ids"]]
+    annot_df = pd.concat([annot_df, subject_info.reset_index(drop=True)], axis=1)
 
     # Select only relevant columns
     annot_df = annot_df[
@@ -711,13 +757,13 @@ def process_frames(df: pd.DataFrame, project_name: str):
     frame_number, user_name, movie_id
     """
 
-    # Create an empty list
-    rows_list = []
+    # Create empty columns and the position of the classification of each annotation
+    positions, xs, ys, ws, hs, labels = [], [], [], [], [], []
 
     # Loop through each classification submitted by the users and flatten them
-    for index, row in df.iterrows():
+    for pos, annotations in enumerate(df["annotations"].values):
         # Load annotations as json format
-        annotations = json.loads(row["annotations"])
+        annotations = json_loads(annotations)
 
         # Select the information from all the labelled animals (e.g. task = T0)
         for ann_i in annotations:
@@ -725,42 +771,31 @@ def process_frames(df: pd.DataFrame, project_name: str):
 
                 if ann_i["value"] == []:
                     # Specify the frame was classified as empty
-                    choice_i = {
-                        "classification_id": row["classification_id"],
-                        "x": None,
-                        "y": None,
-                        "w": None,
-                        "h": None,
-                        "label": "empty",
-                    }
-                    rows_list.append(choice_i)
+                    positions.append(pos)
+                    xs.append(None)
+                    ys.append(None)
+                    ws.append(None)
+                    hs.append(None)
+                    labels.append("empty")
 
                 else:
                     # Select each species annotated and flatten the relevant answers
                     for i in ann_i["value"]:
-                        choice_i = {
-                            "classification_id": row["classification_id"],
-                            "x": int(i["x"]) if "x" in i else None,
-                            "y": int(i["y"]) if "y" in i else None,
-                            "w": int(i["width"]) if "width" in i else None,
-                            "h": int(i["height"]) if "height" in i else None,
-                            "label": str(i["tool_label"])
-                            if "tool_label" in i
-                            else None,
-                        }
-                        rows_list.append(choice_i)
-
-    # Create a data frame with annotations as rows
-    flat_annot_df = pd.DataFrame(
-        rows_list, columns=["classification_id", "x", "y", "w", "h", "label"]
-    )
-
-    # Add other classification information to the flatten classifications
-    annot_df = pd.merge(
-        flat_annot_df,
-        df,
-        how="left",
-        on="classification_id",
+                        positions.append(pos)
+                        xs.append(int(i["x"]) if "x" in i else None)
+                        ys.append(int(i["y"]) if "y" in i else None)
+                        ws.append(int(i["width"]) if "width" in i else None)
+                        hs.append(int(i["height"]) if "height" in i else None)
+                        labels.append(
+                            str(i["tool_label"]) if "tool_label" in i else None
+                        )
+
+    # Add the flatten annotations to the information of their classification
+    annot_df = (
+        df.drop(columns=["x", "y", "w", "h", "label"], errors="ignore")
+        .iloc[positions]
+        .reset_index(drop=True)
+        .assign(x=xs, y=ys, w=ws, h=hs, label=labels)
     )
 
     # Select only relevant columns
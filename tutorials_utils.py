@@ -114,13 +114,14 @@ def get_project_details(project: project_utils.Project):
     return server_i_dict, db_initial_info
 
 
-def initiate_db(project: project_utils.Project):
+def initiate_db(project: project_utils.Project, incremental: bool = False):
     """
     This function takes a project name as input and returns a dictionary with all the information needed
     to connect to the project's database
 
     :param project: The name of the project. This is used to get the project-specific info from the
     config file
+    :param incremental: keep the existing database and update its rows instead of rebuilding it
     :return: A dictionary with the following keys:
         - db_path
         - project_name
@@ -132,7 +133,7 @@ def initiate_db(project: project_utils.Project):
     server_i_dict, db_initial_info = get_project_details(project)
 
     # Initiate the sql db
-    db_utils.init_db(db_initial_info["db_path"])
+    db_utils.init_db(db_initial_info["db_path"], incremental=incremental)
 
     # List the csv files of interest
     list_of_init_csv = [
@@ -142,12 +143,26 @@ def initiate_db(project: project_utils.Project):
         "local_species_csv",
     ]
 
-    # Populate the sites, movies, photos, info
-    for local_i_csv in list_of_init_csv:
-        if local_i_csv in db_initial_info.keys():
-            db_utils.populate_db(
-                db_initial_info=db_initial_info, project=project, local_csv=local_i_csv
-            )
+    # Populate the sites, movies, photos, info in a single bulk-load transaction
+    conn = db_utils.begin_bulk_load(
+        db_initial_info["db_path"], defer_indexes=not incremental
+    )
+    try:
+        for local_i_csv in list_of_init_csv:
+            if local_i_csv in db_initial_info.keys():
+                db_utils.populate_db(
+                    db_initial_info=db_initial_info,
+                    project=project,
+                    local_csv=local_i_csv,
+                    conn=conn,
+                    upsert=incremental,
+                )
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Commit (unless rolled back), restore the pragmas and build the deferred indexes
+        db_utils.end_bulk_load(conn)
 
     # Combine server/project info in a dictionary
     db_info_dict = {**db_initial_info, **server_i_dict}
@@ -181,6 +196,7 @@ def retrieve__populate_zoo_info(
     db_info_dict: dict,
     zoo_project: Project,
     zoo_info: str,
+    incremental: bool = False,
 ):
     """
     It retrieves the information of the subjects uploaded to Zooniverse and populates the SQL database
@@ -190,6 +206,7 @@ def retrieve__populate_zoo_info(
     :param db_info_dict: a dictionary containing the path to the database and the name of the database
     :param zoo_project: The name of the Zooniverse project you created
     :param zoo_info: a string containing the information of the Zooniverse project
+    :param incremental: only add the subjects that are new or changed since the last sync
     :return: The zoo_info_dict is being returned.
     """
 
@@ -205,7 +222,10 @@ def retrieve__populate_zoo_info(
 
         # Populate the sql with subjects uploaded to Zooniverse
         zooniverse_utils.populate_subjects(
-            zoo_info_dict["subjects"], project, db_info_dict["db_path"]
+            zoo_info_dict["subjects"],
+            project,
+            db_info_dict["db_path"],
+            incremental=incremental,
         )
         return zoo_info_dict
 
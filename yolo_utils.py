@@ -1,4 +1,6 @@
 # base imports
+import io
+import csv
 import glob
 import os
 import argparse
@@ -7,6 +9,8 @@ import cv2 as cv
 import numpy as np
 import re
 import pims
+import hashlib
+import sqlite3
 import shutil
 import yaml
 import pandas as pd
@@ -14,18 +18,22 @@ import logging
 import datetime
 import PIL
 import requests
+import multiprocessing
 
 from functools import partial
+from collections import deque
+from multiprocessing import Pool
 from tqdm import tqdm
 from PIL import Image
 from pathlib import Path
 from collections.abc import Callable
 
 # util imports
-from kso_utils.db_utils import create_connection
+from kso_utils.db_utils import get_connection
 from kso_utils.koster_utils import unswedify
 from kso_utils.server_utils import retrieve_movie_info_from_server, get_movie_url
 import kso_utils.project_utils as project_utils
+import kso_utils.movie_utils as movie_utils
 
 # Logging
 logging.basicConfig()
@@ -45,6 +53,10 @@ trackerTypes = [
     "CSRT",
 ]
 
+# Folder and disk budget (in bytes) of the local copies of the images of the subjects
+image_cache_dir = os.path.join(os.path.expanduser("~"), ".kso_cache", "images")
+image_cache_budget = 5 * 1024**3
+
 
 def applyMask(frame: np.ndarray):
     """
@@ -106,32 +118,92 @@ def clearImage(frame: np.ndarray):
     return cv.merge(channels)
 
 
-def ProcFrames(proc_frame_func: Callable, frames_path: str):
+def proc_frames_chunk(
+    proc_frame_func: Callable, frames_path: str, out_path: str, files: list
+):
     """
-    It takes a function that processes a single frame and a path to a folder containing frames, and
-    applies the function to each frame in the folder
+    It applies a function that processes a single frame to a chunk of the frames of a folder, in the
+    process of a worker of ProcFrames
 
     :param proc_frame_func: The function that will be applied to each frame
+    :param frames_path: The path to the directory containing the frames
+    :param out_path: The path to the directory to write the processed frames to
+    :param files: The names of the frames of the chunk
+    :return: the id of the worker process, the number of frames processed and the time it took to
+    process them
+    """
+    start = time.time()
+    n_frames = 0
+    for f in files:
+        frame = cv.imread(str(Path(frames_path, f)))
+        if frame is None:
+            frame = cv.imread(unswedify(str(Path(frames_path, f))))
+        if frame is None:
+            logging.warning(f"Unable to read frame {f}")
+            continue
+        cv.imwrite(str(Path(out_path, f)), proc_frame_func(frame))
+        n_frames += 1
+    return os.getpid(), n_frames, time.time() - start
+
+
+def ProcFrames(
+    proc_frame_func: Callable,
+    frames_path: str,
+    out_path: str = None,
+    pool_size: int = None,
+    chunk_size: int = 64,
+):
+    """
+    It takes a function that processes a single frame and a path to a folder containing frames, and
+    applies the function to each frame in the folder. The frames are split in chunks processed by a
+    pool of processes
+
+    :param proc_frame_func: The function that will be applied to each frame, it must be picklable
     :type proc_frame_func: Callable
     :param frames_path: The path to the directory containing the frames
     :type frames_path: str
+    :param out_path: The path to the directory to write the processed frames to, defaults to
+    frames_path (the frames are processed in place)
+    :type out_path: str (optional)
+    :param pool_size: The number of processes, defaults to the number of cpus
+    :type pool_size: int (optional)
+    :param chunk_size: The number of frames processed by a worker at a time
+    :type chunk_size: int (optional)
     :return: The time it took to process all the frames in the folder, and the number of frames
     processed.
     """
     start = time.time()
-    files = os.listdir(frames_path)
-    for f in files:
-        if f.endswith((".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif")):
-            if os.path.exists(str(Path(frames_path, f))):
-                new_frame = proc_frame_func(cv.imread(str(Path(frames_path, f))))
-                cv.imwrite(str(Path(frames_path, f)), new_frame)
-            else:
-                new_frame = proc_frame_func(
-                    cv.imread(unswedify(str(Path(frames_path, f))))
-                )
-                cv.imwrite(str(Path(frames_path, f)), new_frame)
+    out_path = out_path or frames_path
+    os.makedirs(out_path, exist_ok=True)
+
+    files = [
+        f
+        for f in sorted(os.listdir(frames_path))
+        if f.endswith((".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif"))
+    ]
+    if not files:
+        return 0, 0
+    chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+
+    # Process the chunks, keeping the frames processed and time spent by each worker
+    workers = {}
+    n_frames = 0
+    with Pool(pool_size or os.cpu_count()) as pool:
+        for pid, n, seconds in pool.imap_unordered(
+            partial(proc_frames_chunk, proc_frame_func, frames_path, out_path), chunks
+        ):
+            worker_frames, worker_seconds = workers.get(pid, (0, 0))
+            workers[pid] = (worker_frames + n, worker_seconds + seconds)
+            n_frames += n
+
+    for pid, (worker_frames, worker_seconds) in workers.items():
+        if worker_frames:
+            logging.info(
+                f"Worker {pid}: {worker_frames} frames, {worker_seconds * 1000 / worker_frames:.2f} ms/frame"
+            )
+
     end = time.time()
-    return (end - start) * 1000 / len(files), len(files)
+    return (end - start) * 1000 / max(n_frames, 1), n_frames
 
 
 def ProcVid(proc_frame_func: Callable, vidPath: str):
@@ -224,15 +296,25 @@ def prepare(data_path, percentage_test, out_path):
 
 
 # utility functions
-def process_frames(frames_path: str, size: tuple = (416, 416)):
+def process_frames(
+    frames_path: str,
+    size: tuple = (416, 416),
+    out_path: str = None,
+    pool_size: int = None,
+):
     """
     It takes a path to a directory containing frames, and returns a list of processed frames
 
     :param frames_path: the path to the directory containing the frames
     :param size: The size of the image to be processed
+    :param out_path: the path to the directory to write the processed frames to, defaults to
+    frames_path (the frames are processed in place)
+    :param pool_size: the number of processes, defaults to the number of cpus
     """
     # Run tests
-    gpu_time_0, n_frames = ProcFrames(partial(ProcFrameCuda, size=size), frames_path)
+    gpu_time_0, n_frames = ProcFrames(
+        partial(ProcFrameCuda, size=size), frames_path, out_path, pool_size
+    )
     logging.info(
         f"Processing performance: {n_frames} frames, {gpu_time_0:.2f} ms/frame"
     )
@@ -291,6 +373,412 @@ def split_frames(data_path: str, perc_test: float):
             counter += 1
 
 
+def yolo_labels(boxes: list, f_w: int, f_h: int):
+    """
+    Format the bounding boxes of a frame as yolo labels (class, center and size of the box relative
+    to the size of the frame), skipping the null boxes
+
+    :param boxes: a list of tuples with the class id, x, y, width and height of each box
+    :param f_w: the width of the frame
+    :param f_h: the height of the frame
+    :return: the labels of the frame, one box per line
+    """
+    return "\n".join(
+        "{} {:.6f} {:.6f} {:.6f} {:.6f}".format(
+            class_id,
+            min((x + w / 2) / f_w, 1.0),
+            min((y + h / 2) / f_h, 1.0),
+            min(w / f_w, 1.0),
+            min(h / f_h, 1.0),
+        )
+        for class_id, x, y, w, h in boxes
+        if str(h) != "nan"
+    )
+
+
+def connect_image_index(cache_dir: str):
+    """
+    Connect to the index of the image cache, which keeps the file and dimensions of each image url
+
+    :param cache_dir: the folder of the image cache
+    :return: Connection object
+    """
+    conn = sqlite3.connect(os.path.join(cache_dir, "index.db"), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS images (
+            url TEXT PRIMARY KEY,
+            filename TEXT,
+            width INTEGER,
+            height INTEGER
+        )"""
+    )
+    return conn
+
+
+def fetch_image(image_path: str, cache_dir: str = image_cache_dir, timeout: int = 30):
+    """
+    Get a local copy of an image and its dimensions. Urls are downloaded once into a content-addressed
+    cache (the files are named by the sha256 of their content) and their dimensions are kept in the index
+    of the cache, so the image isn't downloaded or decoded again to get them. Each use of a cached image
+    is recorded in its access time (see evict_image_cache)
+
+    :param image_path: the path (or url) of the image
+    :param cache_dir: the folder of the image cache
+    :param timeout: the number of seconds to wait for the response of urls, defaults to 30
+    :return: the local path to the image, and its width and height
+    """
+    if not image_path.startswith("http"):
+        with PIL.Image.open(image_path) as image:
+            return (image_path,) + image.size
+
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = connect_image_index(cache_dir)
+    try:
+        row = conn.execute(
+            "SELECT filename, width, height FROM images WHERE url = ?", (image_path,)
+        ).fetchone()
+        if row is not None and os.path.exists(os.path.join(cache_dir, row[0])):
+            cache_path = os.path.join(cache_dir, row[0])
+            os.utime(cache_path, (time.time(), os.path.getmtime(cache_path)))
+            return cache_path, row[1], row[2]
+
+        # Download the image once
+        response = requests.get(image_path, timeout=timeout)
+        response.raise_for_status()
+        with Image.open(io.BytesIO(response.content)) as image:
+            width, height = image.size
+            ext = "." + (image.format or "img").lower()
+
+        filename = hashlib.sha256(response.content).hexdigest() + ext
+        cache_path = os.path.join(cache_dir, filename)
+        if not os.path.exists(cache_path):
+            # Write to a temporary file first, other writers could be caching the same image
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(response.content)
+            os.replace(tmp_path, cache_path)
+
+        conn.execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+            (image_path, filename, width, height),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    return cache_path, width, height
+
+
+def evict_image_cache(
+    cache_dir: str = image_cache_dir, cache_budget: int = image_cache_budget
+):
+    """
+    Remove the least recently used images from the image cache until it fits in the disk budget,
+    along with their entries in the index of the cache. The last use of each image is its access time
+
+    :param cache_dir: the folder of the image cache
+    :param cache_budget: the maximum size of the images in the cache, in bytes
+    """
+    if not os.path.exists(os.path.join(cache_dir, "index.db")):
+        return
+
+    conn = connect_image_index(cache_dir)
+    try:
+        cached_files = sorted(
+            (
+                os.path.join(cache_dir, f[0])
+                for f in conn.execute("SELECT DISTINCT filename FROM images")
+                if os.path.exists(os.path.join(cache_dir, f[0]))
+            ),
+            key=os.path.getatime,
+        )
+        cache_size = sum(os.path.getsize(f) for f in cached_files)
+
+        while cached_files and cache_size > cache_budget:
+            oldest_file = cached_files.pop(0)
+            cache_size -= os.path.getsize(oldest_file)
+            os.remove(oldest_file)
+            conn.execute(
+                "DELETE FROM images WHERE filename = ?",
+                (os.path.basename(oldest_file),),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def write_yolo_frame(frame_task: dict):
+    """
+    Write the image and the labels of a frame of the dataset. The frame is either given as an array
+    (read from a movie) or as the path/url of an image, which is then read by the writer. If the task
+    has an img_size, the image is pre-processed (see ProcFrameCuda) before it is written, so it is
+    encoded once. The labels are written after the image, so there are no labels without an image
+
+    :param frame_task: a dictionary with the frame (or None), image_path, img_out, label_out (None to
+    skip the labels) and boxes of the frame, and optionally the cache_dir of the images and the
+    img_size to pre-process the image to
+    :return: a tuple with the path to the image and labels, the number of boxes and the width and
+    height of the frame
+    """
+    if frame_task["frame"] is not None:
+        # Movie frames are read as BGR
+        image = Image.fromarray(frame_task["frame"][:, :, [2, 1, 0]])
+        f_w, f_h = image.size
+    else:
+        # Get the image (downloaded once) and its dimensions from the cache
+        image_path, f_w, f_h = fetch_image(
+            frame_task["image_path"], frame_task.get("cache_dir", image_cache_dir)
+        )
+
+    if frame_task.get("img_size") is not None:
+        # Pre-process the frame (as BGR, like the frames read by ProcFrames). Images are
+        # read with PIL, without applying their EXIF orientation, so the pixels match the
+        # dimensions the labels are normalised with
+        if frame_task["frame"] is not None:
+            frame = frame_task["frame"]
+        else:
+            with PIL.Image.open(image_path) as image:
+                frame = np.asarray(image.convert("RGB"))[:, :, ::-1]
+        cv.imwrite(
+            frame_task["img_out"],
+            ProcFrameCuda(np.ascontiguousarray(frame), size=frame_task["img_size"]),
+        )
+    elif frame_task["frame"] is not None:
+        image.save(frame_task["img_out"])
+    elif os.path.splitext(image_path)[1].lower() in [".jpg", ".jpeg"]:
+        # Reuse the bytes of jpeg images
+        shutil.copyfile(image_path, frame_task["img_out"])
+    else:
+        with PIL.Image.open(image_path) as image:
+            Image.fromarray(np.asarray(image)).save(frame_task["img_out"])
+
+    labels = yolo_labels(frame_task["boxes"], f_w, f_h)
+    if frame_task["label_out"] is not None:
+        with open(frame_task["label_out"], "w") as f:
+            f.write(labels)
+
+    return (
+        frame_task["img_out"],
+        frame_task["label_out"],
+        len(labels.splitlines()),
+        f_w,
+        f_h,
+    )
+
+
+def open_movie_reader(movie_path: str):
+    """
+    > This function opens the reader of a movie, falling back to the unswedified path of the movie
+    if it isn't found
+
+    :param movie_path: the path (or url) of the movie
+    :return: a pims reader of the movie
+    """
+    try:
+        return pims.MoviePyReader(movie_path)
+    except FileNotFoundError:
+        return pims.Video(unswedify(str(movie_path)))
+
+
+def iter_movie_frames(
+    train_rows: pd.DataFrame,
+    readers: movie_utils.MovieReaderPool,
+    out_path: str,
+    class_id: Callable,
+    out_format: str = "yolo",
+    track_frames: bool = True,
+    n_tracked_frames: int = 10,
+    trackerType: str = "CSRT",
+):
+    """
+    Generate the frames of the dataset from the movies, one movie at a time in frame order. The boxes
+    of each movie (including the tracked ones) are gathered before its frames are read, so the boxes of
+    a frame annotated and tracked from another frame end up in the same labels. The readers of the
+    movies are taken from the pool as the movies are reached, and all the tracking windows of a movie
+    are tracked in a single pass (see track_movie_objects)
+
+    :param train_rows: a dataframe with the movie_path, frame_number, species_id and box of the annotations
+    :param readers: the pool of movie readers, opening the readers with open_movie_reader
+    :param out_path: the path to the folder of the dataset
+    :param class_id: a function returning the class id of a species id
+    :param out_format: the format of the labels, labels are only written for yolo
+    :param track_frames: track the boxes for n_tracked_frames frames after the annotated frame
+    :param n_tracked_frames: number of frames to track after an object is detected
+    :param trackerType: the type of tracker to use (see trackerTypes)
+    :return: a generator of frame tasks for write_yolo_frame
+    """
+    box_fields = ["x_position", "y_position", "width", "height"]
+
+    for movie_path, movie_rows in train_rows.groupby("movie_path", sort=True):
+        try:
+            video = readers.get(movie_path)
+        except (FileNotFoundError, KeyError, OSError):
+            logging.warning(f"Missing file {movie_path}")
+            continue
+        file_base = os.path.basename(os.path.splitext(movie_path)[0])
+
+        # Gather the boxes of each frame of the movie and the windows to track
+        frame_boxes = {}
+        windows = []
+        for (frame_number, species_id), group in movie_rows.groupby(
+            ["frame_number", "species_id"]
+        ):
+            frame_number = int(frame_number)
+            if frame_number >= len(video):
+                logging.warning(f"Frame out of range for video of length {len(video)}")
+                continue
+
+            bboxes = [tuple(i) for i in group[box_fields].values]
+            frame_boxes.setdefault(frame_number, []).extend(
+                (class_id(species_id),) + box for box in bboxes
+            )
+
+            if track_frames:
+                # Track n frames after object is detected
+                bboxes = [box for box in bboxes if str(box[-1]) != "nan"]
+                if bboxes:
+                    windows.append(
+                        (
+                            (frame_number, species_id),
+                            bboxes,
+                            frame_number,
+                            min(frame_number + n_tracked_frames, len(video) - 1),
+                        )
+                    )
+
+        # Track the objects of all the windows in one pass over the movie
+        for (frame_number, species_id), t_bbox in track_movie_objects(
+            video, windows, trackerType
+        ).items():
+            for box in t_bbox:
+                frame_boxes.setdefault(frame_number + box[0], []).append(
+                    (class_id(species_id),) + tuple(box[1:])
+                )
+
+        for frame_number in sorted(frame_boxes):
+            yield {
+                "frame": video[frame_number],
+                "image_path": movie_path,
+                "img_out": f"{out_path}/images/{file_base}_frame_{frame_number}.jpg",
+                "label_out": f"{out_path}/labels/{file_base}_frame_{frame_number}.txt"
+                if out_format == "yolo"
+                else None,
+                "boxes": frame_boxes[frame_number],
+            }
+
+
+def iter_image_frames(
+    train_rows: pd.DataFrame,
+    image_paths: dict,
+    out_path: str,
+    class_id: Callable,
+    out_format: str = "yolo",
+    cache_dir: str = image_cache_dir,
+):
+    """
+    Generate the frames of the dataset from images (local or urls). The images are read by the writers,
+    which download each url once into the image cache (see fetch_image)
+
+    :param train_rows: a dataframe with the image_key, species_id and box of the annotations
+    :param image_paths: a dictionary with the path (or url) of the image of each image_key
+    :param out_path: the path to the folder of the dataset
+    :param class_id: a function returning the class id of a species id
+    :param out_format: the format of the labels, labels are only written for yolo
+    :param cache_dir: the folder of the image cache
+    :return: a generator of frame tasks for write_yolo_frame
+    """
+    box_fields = ["x_position", "y_position", "width", "height"]
+
+    for image_key, image_rows in train_rows.groupby("image_key", sort=False):
+        image_path = image_paths[image_key]
+        file_base = os.path.basename(os.path.splitext(image_path)[0])
+
+        yield {
+            "frame": None,
+            "image_path": image_path,
+            "cache_dir": cache_dir,
+            "img_out": f"{out_path}/images/{file_base}.jpg",
+            "label_out": f"{out_path}/labels/{file_base}.txt"
+            if out_format == "yolo"
+            else None,
+            "boxes": [
+                (class_id(i[0]),) + tuple(i[1:])
+                for i in image_rows[["species_id"] + box_fields].values
+            ],
+        }
+
+
+def build_yolo_dataset(
+    frame_tasks,
+    out_path: str,
+    pool_size: int = 4,
+    img_size: tuple = None,
+    frame_timeout: float = 300,
+):
+    """
+    Write the frames of a dataset with a pool of writers (see write_yolo_frame) as they are generated,
+    keeping a manifest of the frames written. The frames waiting for a writer are bounded, so the
+    memory used doesn't grow with the size of the dataset. The results of the writers are collected in
+    order, and a frame not written within the timeout (e.g. its writer was killed) is reported as
+    failed instead of waiting for it forever
+
+    :param frame_tasks: an iterable of frame tasks (see iter_movie_frames and iter_image_frames)
+    :param out_path: the path to the folder of the dataset
+    :param pool_size: the number of writers, defaults to 4
+    :param img_size: the size to pre-process the frames to as they are written, defaults to None
+    (the frames are written as they are)
+    :param frame_timeout: the number of seconds to wait for a frame to be written, defaults to 300
+    :return: the number of frames written, and the list of the frames that couldn't be written
+    """
+    pending = deque()
+    n_frames = 0
+    failed_frames = []
+
+    # The writers are terminated once all the frames are collected, or if the frames can't be
+    # generated (e.g. a movie fails to decode)
+    with open(Path(out_path, "manifest.csv"), "w", newline="") as f, tqdm(
+        desc="Saving frames...", colour="green"
+    ) as pbar, Pool(pool_size) as pool:
+        manifest = csv.writer(f)
+        manifest.writerow(["image", "label", "n_boxes", "width", "height"])
+
+        def collect_frame():
+            nonlocal n_frames
+            img_out, result = pending.popleft()
+            try:
+                manifest.writerow(result.get(timeout=frame_timeout))
+                n_frames += 1
+                pbar.update(1)
+            except multiprocessing.TimeoutError:
+                logging.error(
+                    f"The frame {img_out} wasn't written after {frame_timeout} seconds"
+                )
+                failed_frames.append(img_out)
+            except Exception as e:
+                logging.error(f"The frame {img_out} couldn't be written, {e}")
+                failed_frames.append(img_out)
+
+        for frame_task in frame_tasks:
+            frame_task["img_size"] = img_size
+            if len(pending) >= pool_size * 4:
+                collect_frame()
+            pending.append(
+                (
+                    frame_task["img_out"],
+                    pool.apply_async(write_yolo_frame, (frame_task,)),
+                )
+            )
+        while pending:
+            collect_frame()
+
+    if failed_frames:
+        logging.error(
+            f"{len(failed_frames)} frames couldn't be written and are missing from the dataset"
+        )
+
+    return n_frames, failed_frames
+
+
 def frame_aggregation(
     project: project_utils.Project,
     db_info_dict: dict,
@@ -303,6 +791,11 @@ def frame_aggregation(
     track_frames: bool = True,
     n_tracked_frames: int = 10,
     agg_df: pd.DataFrame = pd.DataFrame(),
+    pool_size: int = 4,
+    cache_dir: str = image_cache_dir,
+    max_open_movies: int = 4,
+    trackerType: str = "CSRT",
+    cache_budget: int = image_cache_budget,
 ):
     """
     It takes a project, a database, an output path, a percentage of frames to use for testing, a list of
@@ -330,9 +823,22 @@ def frame_aggregation(
     :type track_frames: bool (optional)
     :param n_tracked_frames: number of frames to track after an object is detected, defaults to 10
     :type n_tracked_frames: int (optional)
+    :param agg_df: the aggregated classifications to build the dataset from
+    :param pool_size: the number of processes writing the frames and labels, defaults to 4
+    :type pool_size: int (optional)
+    :param cache_dir: the folder to cache the images of the subjects, defaults to ~/.kso_cache/images
+    :type cache_dir: str (optional)
+    :param cache_budget: the maximum size of the image cache (see evict_image_cache), in bytes,
+    defaults to 5GB
+    :type cache_budget: int (optional)
+    :param max_open_movies: the maximum number of movies open at the same time, defaults to 4
+    :type max_open_movies: int (optional)
+    :param trackerType: the type of tracker used to track the frames (see trackerTypes), KCF and MOSSE
+    are faster but less accurate, defaults to CSRT
+    :type trackerType: str (optional)
     """
     # Establish connection to database
-    conn = create_connection(db_info_dict["db_path"])
+    conn = get_connection(db_info_dict["db_path"], read_only=True)
 
     # Select the id/s of species of interest
     if class_list[0] == "":
@@ -453,6 +959,7 @@ def frame_aggregation(
     # If at least one movie is linked to the project
     logging.info(f"There are {len(movie_df)} movies")
 
+    movie_bool = False
     if len(movie_df) > 0:
         if "frame_number" in train_rows.columns and not pd.isnull(train_rows["frame_number"]).any():
             movie_bool = True
@@ -463,7 +970,7 @@ def frame_aggregation(
     link_bool = "https_location" in train_rows.columns
     image_bool = project.photo_folder is not None
     
-    if not all([movie_bool, link_bool, image_bool]):
+    if not any([movie_bool, link_bool, image_bool]):
         logging.error("No source of footage for aggregation found. Please check your metadata "
                       "and project setup before running this function again.")
         return None
@@ -479,16 +986,8 @@ def frame_aggregation(
             lambda x: get_movie_url(project, db_info_dict, x)
         )
 
-        # Read each movie for efficient frame access
-        video_dict = {}
-        for i in tqdm(train_rows["movie_path"].unique()):
-            try:
-                video_dict[i] = pims.MoviePyReader(i)
-            except FileNotFoundError:
-                try:
-                    video_dict[unswedify(str(i))] = pims.Video(unswedify(str(i)))
-                except KeyError:
-                    logging.warning("Missing file" + f"{i}")
+        # Open the movies lazily, keeping at most max_open_movies open
+        readers = movie_utils.MovieReaderPool(max_open_movies, open_movie_reader)
 
         # Create full rows
         train_rows = train_rows.sort_values(
@@ -529,221 +1028,64 @@ def frame_aggregation(
     # Get relevant fields from dataframe (before groupby)
     train_rows = train_rows[key_fields]
 
-    group_fields = (
-        ["subject_ids", "species_id"]
-        if link_bool
-        else (
-            ["movie_path", "frame_number", "species_id"]
-            if movie_bool
-            else ["filename", "species_id"]
-        )
-    )
-
-    new_rows = []
-    bboxes = {}
-    tboxes = {}
-
-    for name, group in tqdm(train_rows.groupby(group_fields)):
-        grouped_fields = name[: len(group_fields)]
-        if not movie_bool:
-            # Get the filenames of the images
-            filename = (
-                agg_df[agg_df.subject_ids == grouped_fields[0]]["https_location"].iloc[
-                    0
-                ]
-                if link_bool
-                else project.photo_folder + grouped_fields[0]
-            )
-            named_tuple = tuple([grouped_fields[1], filename])
-        else:
-            # Get movie_path and frame_number
-            rev_fields = grouped_fields.reverse()
-            named_tuple = tuple([rev_fields])
+    # Get the class id of each species (0 when working with a single class)
+    def class_id(species_id):
+        return 0 if len(class_list) == 1 else sp_id2mod_id[species_id]
 
-        if movie_bool:
-            final_name = name[0] if name[0] in video_dict else unswedify(name[0])
-
-            if grouped_fields[1] > len(video_dict[final_name]):
-                logging.warning(
-                    f"Frame out of range for video of length {len(video_dict[final_name])}"
-                )
-
-            if final_name in video_dict:
-                bboxes[named_tuple], tboxes[named_tuple] = [], []
-                bboxes[named_tuple].extend(
-                    tuple(i[len(grouped_fields) :]) for i in group.values
-                )
-                movie_w, movie_h = video_dict[final_name][0].shape
-
-                for box in bboxes[named_tuple]:
-                    new_rows.append(
-                        (
-                            grouped_fields[-1],
-                            grouped_fields[1],
-                            grouped_fields[0],
-                            movie_h,
-                            movie_w,
-                        )
-                        + box
-                    )
-
-                if track_frames:
-                    # Track n frames after object is detected
-                    tboxes[named_tuple].extend(
-                        track_objects(
-                            video_dict[final_name],
-                            grouped_fields[-1],
-                            bboxes[named_tuple],
-                            grouped_fields[1],
-                            grouped_fields[1] + n_tracked_frames,
-                        )
-                    )
-                    for box in tboxes[named_tuple]:
-                        new_rows.append(
-                            (
-                                grouped_fields[-1],
-                                grouped_fields[1] + box[0],
-                                grouped_fields[-1],
-                                video_dict[final_name][grouped_fields[1]].shape[1],
-                                video_dict[final_name][grouped_fields[1]].shape[0],
-                            )
-                            + box[1:]
-                        )
-        else:
-            # Track intermediate frames
-            bboxes[named_tuple] = []
-            bboxes[named_tuple].extend(
-                tuple(i[len(grouped_fields) :]) for i in group.values
-            )
-
-            for box in bboxes[named_tuple]:
-                new_rows.append(
-                    (
-                        grouped_fields[-1],  # species_id
-                        filename,
-                        Image.open(requests.get(filename, stream=True).raw).size[0]
-                        if link_bool
-                        else PIL.Image.open(filename).size[0],
-                        Image.open(requests.get(filename, stream=True).raw).size[1]
-                        if link_bool
-                        else PIL.Image.open(filename).size[1],
-                    )
-                    + box
-                )
-
-    ### Final export step
     if movie_bool:
-        # Export full rows
-        full_rows = pd.DataFrame(
-            new_rows,
-            columns=[
-                "species_id",
-                "frame_number",
-                "filename",
-                "f_w",
-                "f_h",
-                "x",
-                "y",
-                "w",
-                "h",
-            ],
+        frame_tasks = iter_movie_frames(
+            train_rows,
+            readers,
+            out_path,
+            class_id,
+            out_format,
+            track_frames,
+            n_tracked_frames,
+            trackerType,
         )
-        f_group_fields = ["frame_number", "filename"]
     else:
-        full_rows = pd.DataFrame(
-            new_rows,
-            columns=[
-                "species_id",
-                "filename",
-                "f_w",
-                "f_h",
-                "x",
-                "y",
-                "w",
-                "h",
-            ],
-        )
-        f_group_fields = ["filename"]
-
-    # Find indices of important fields
-    col_list = list(full_rows.columns)
-    fw_pos, fh_pos, x_pos, y_pos, w_pos, h_pos, speciesid_pos = (
-        col_list.index("f_w"),
-        col_list.index("f_h"),
-        col_list.index("x"),
-        col_list.index("y"),
-        col_list.index("w"),
-        col_list.index("h"),
-        col_list.index("species_id"),
-    )
-
-    for name, groups in tqdm(
-        full_rows.groupby(f_group_fields),
-        desc="Saving frames...",
-        colour="green",
-    ):
-        if movie_bool:
-            file, ext = os.path.splitext(name[1])
-            file_base = os.path.basename(file)
-            file_out = f"{out_path}/labels/{file_base}_frame_{name[0]}.txt"
-            img_out = f"{out_path}/images/{file_base}_frame_{name[0]}.jpg"
+        if link_bool:
+            # Get the url of the image of each subject
+            image_paths = (
+                agg_df.drop_duplicates("subject_ids")
+                .set_index("subject_ids")["https_location"]
+                .to_dict()
+            )
+            train_rows = train_rows.rename(columns={"subject_ids": "image_key"})
         else:
-            file, ext = os.path.splitext(name)
-            file_base = os.path.basename(file)
-            file_out = f"{out_path}/labels/{file_base}.txt"
-            img_out = f"{out_path}/images/{file_base}.jpg"
-
-        # Added condition to avoid bounding boxes outside of maximum size of frame + added 0 class id when working with single class
-        if out_format == "yolo":
-            if len(groups.values) == 1 and str(groups.values[0][-1]) == "nan":
-                # Empty files
-                open(file_out, "w")
-            else:
-                groups = [i for i in groups.values if str(i[-1]) != "nan"]
-                open(file_out, "w").write(
-                    "\n".join(
-                        [
-                            "{} {:.6f} {:.6f} {:.6f} {:.6f}".format(
-                                0
-                                if len(class_list) == 1
-                                else sp_id2mod_id[
-                                    i[speciesid_pos]
-                                ],  # single class vs multiple classes
-                                min((i[x_pos] + i[w_pos] / 2) / i[fw_pos], 1.0),
-                                min((i[y_pos] + i[h_pos] / 2) / i[fh_pos], 1.0),
-                                min(i[w_pos] / i[fw_pos], 1.0),
-                                min(i[h_pos] / i[fh_pos], 1.0),
-                            )
-                            for i in groups
-                        ]
-                    )
-                )
+            train_rows = train_rows.rename(columns={"filename": "image_key"})
+            image_paths = {
+                i: project.photo_folder + i for i in train_rows["image_key"].unique()
+            }
+        frame_tasks = iter_image_frames(
+            train_rows, image_paths, out_path, class_id, out_format, cache_dir
+        )
 
-        # Save frames to image files
+    # Write the frames (pre-processed) and labels of the dataset as they are generated
+    try:
+        n_frames, failed_frames = build_yolo_dataset(
+            frame_tasks, out_path, pool_size, tuple(img_size)
+        )
+    finally:
         if movie_bool:
-            save_name = name[1] if name[1] in video_dict else unswedify(name[1])
-            if save_name in video_dict:
-                Image.fromarray(video_dict[save_name][name[0]][:, :, [2, 1, 0]]).save(
-                    img_out
-                )
+            readers.close()
         else:
-            if link_bool:
-                image_output = Image.open(requests.get(name, stream=True).raw)
-            else:
-                image_output = np.asarray(PIL.Image.open(name))
-            Image.fromarray(np.asarray(image_output)).save(img_out)
+            # Keep the image cache within its disk budget once the images are copied
+            evict_image_cache(cache_dir, cache_budget)
 
-    logging.info("Frames extracted successfully")
+    if failed_frames:
+        logging.warning(
+            f"{n_frames} frames extracted, {len(failed_frames)} failed (see the errors above)"
+        )
+    else:
+        logging.info("Frames extracted successfully")
 
     # Check that at least some frames remain after aggregation
-    if len(full_rows) == 0:
+    if n_frames == 0:
         raise Exception(
             "No frames found for the selected species. Please retry with a different configuration."
         )
 
-    # Pre-process frames
-    process_frames(out_path + "/images", size=tuple(img_size))
-
     # Create training/test sets
     split_frames(out_path, perc_test)
 
@@ -782,8 +1124,78 @@ def createTrackerByName(trackerType: str):
     return tracker
 
 
+def track_movie_objects(video, windows: list, trackerType: str = "CSRT"):
+    """
+    It tracks the objects of several tracking windows of a movie in a single forward pass. Each frame
+    is decoded once and shared by the trackers of all the windows it belongs to, so overlapping
+    windows don't decode the same frames again
+
+    :param video: the video to be tracked
+    :param windows: a list of (key, bboxes, start_frame, last_frame) tuples, one per tracking window
+    :param trackerType: the type of tracker to use (see trackerTypes), KCF and MOSSE are faster but
+    less accurate than CSRT
+    :return: a dictionary with the list of (t, x, y, width, height) tuples of each window key, where t
+    is the number of frames tracked after the start frame
+    """
+    # Sort the windows by start frame
+    windows = sorted(
+        [w for w in windows if w[3] > w[2] and len(w[1]) > 0], key=lambda w: w[2]
+    )
+    t_bboxes = {w[0]: [] for w in windows}
+
+    # The trackers (and frames tracked) of the windows being tracked, by window key
+    active = {}
+    next_window = 0
+    current_frame = windows[0][2] if windows else 0
+    while next_window < len(windows) or active:
+        # Skip the frames between windows
+        if not active and windows[next_window][2] > current_frame:
+            current_frame = windows[next_window][2]
+
+        # Decode the frame once for all the trackers
+        frame = video[current_frame]  # [0]
+
+        # Update the trackers of the windows being tracked
+        for key, (multiTracker, last_frame, t) in list(active.items()):
+            success, boxes = multiTracker.update(frame)
+            if success:
+                t += 1
+                for newbox in boxes:
+                    t_bboxes[key].append(
+                        (
+                            t,
+                            int(newbox[0]),
+                            int(newbox[1]),
+                            int(newbox[2]),
+                            int(newbox[3]),
+                        )
+                    )
+            if current_frame >= last_frame:
+                del active[key]
+            else:
+                active[key] = (multiTracker, last_frame, t)
+
+        # Initialize the trackers of the windows starting in this frame
+        while next_window < len(windows) and windows[next_window][2] == current_frame:
+            key, bboxes, _, last_frame = windows[next_window]
+            multiTracker = cv.legacy.MultiTracker_create()
+            for bbox in bboxes:
+                multiTracker.add(createTrackerByName(trackerType), frame, bbox)
+            active[key] = (multiTracker, last_frame, 0)
+            next_window += 1
+
+        current_frame += 1
+
+    return t_bboxes
+
+
 def track_objects(
-    video, class_ids: list, bboxes: list, start_frame: int, last_frame: int
+    video,
+    class_ids: list,
+    bboxes: list,
+    start_frame: int,
+    last_frame: int,
+    trackerType: str = "CSRT",
 ):
     """
     It takes a video, a list of bounding boxes, and a start and end frame, and returns a list of tuples
@@ -794,42 +1206,56 @@ def track_objects(
     :param bboxes: the bounding boxes of the objects to be tracked
     :param start_frame: the frame number to start tracking from
     :param last_frame: the last frame of the video to be processed
+    :param trackerType: the type of tracker to use (see trackerTypes), defaults to CSRT
     :return: A list of tuples, where each tuple contains the frame number, x, y, width, and height of
     the bounding box.
     """
+    return track_movie_objects(
+        video, [(0, bboxes, start_frame, last_frame)], trackerType
+    ).get(0, [])
 
-    # Set video to load
-    # colors = [(randint(0, 255)) for i in bboxes]
-
-    # Specify the tracker type
-    trackerType = "CSRT"
-
-    # Create MultiTracker object
-    multiTracker = cv.legacy.MultiTracker_create()
-
-    # Extract relevant frame
-    frame = video[start_frame]  # [0]
 
-    # Initialize MultiTracker
-    for bbox in bboxes:
-        multiTracker.add(createTrackerByName(trackerType), frame, bbox)
-
-    t_bbox = []
-    t = 0
-    # Process video and track objects
-    for current_frame in range(start_frame + 1, last_frame + 1):
-        frame = video[current_frame]  # [0]
+def benchmark_trackers(
+    video,
+    bboxes: list,
+    start_frame: int,
+    last_frame: int,
+    tracker_types: tuple = ("CSRT", "KCF", "MOSSE"),
+):
+    """
+    It measures the throughput of several tracker types on the same tracking window. The frames are
+    decoded before timing the trackers, so only the tracking is measured
 
-        # get updated location of objects in subsequent frames
-        success, boxes = multiTracker.update(frame)
-        if success:
-            t += 1
-            for i, newbox in enumerate(boxes):
-                t_bbox.append(
-                    (t, int(newbox[0]), int(newbox[1]), int(newbox[2]), int(newbox[3]))
-                )
+    :param video: the video to be tracked
+    :param bboxes: the bounding boxes of the objects to be tracked
+    :param start_frame: the frame number to start tracking from
+    :param last_frame: the last frame of the video to be processed
+    :param tracker_types: the types of tracker to compare, defaults to CSRT, KCF and MOSSE
+    :return: a dataframe with the frames tracked, seconds and frames per second of each tracker type
+    """
+    frames = {i: video[i] for i in range(start_frame, last_frame + 1)}
+
+    results = []
+    for trackerType in tracker_types:
+        start_time = time.time()
+        t_bbox = track_movie_objects(
+            frames, [(0, bboxes, start_frame, last_frame)], trackerType
+        )[0]
+        seconds = time.time() - start_time
+        n_frames = last_frame - start_frame
+        fps = n_frames / seconds if seconds > 0 else None
+        results.append(
+            {
+                "tracker": trackerType,
+                "frames": n_frames,
+                "tracked_boxes": len(t_bbox),
+                "seconds": seconds,
+                "fps": fps,
+            }
+        )
+        logging.info(f"{trackerType} tracked {n_frames} frames in {seconds:.2f}s")
 
-    return t_bbox
+    return pd.DataFrame(results)
 
 
 def main():
@@ -2,6 +2,10 @@
 
 # base imports
 import io
+import os
+import re
+import glob
+import time
 import getpass
 import pandas as pd
 import json
@@ -27,6 +31,10 @@ import kso_utils.project_utils as project_utils
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
+# Folder and disk budget (in bytes) of the local copies of the Zooniverse exports
+export_cache_dir = os.path.join(os.path.expanduser("~"), ".kso_cache", "zoo_exports")
+export_cache_budget = 5 * 1024**3
+
 
 def zoo_credentials():
     zoo_user = getpass.getpass("Enter your Zooniverse user")
@@ -64,9 +72,216 @@ def auth_session(username: str, password: str, project_n: int):
         logging.error(e)
 
 
+def get_export_cache_path(
+    zoo_project: Project, info_n: str, updated_at: str, cache_dir: str
+):
+    """
+    > This function returns the path of the local copy of a Zooniverse export, keyed by the
+    project, the type of export and the time the export was last updated
+
+    :param zoo_project: the Zooniverse project object
+    :param info_n: the type of export, e.g. "classifications"
+    :param updated_at: the time the export was updated, as reported by Zooniverse
+    :param cache_dir: the folder with the local copies of the exports
+    :return: The path to the parquet file of the export
+    """
+    updated_at = re.sub(r"[^0-9A-Za-z]", "", str(updated_at))
+    return os.path.join(cache_dir, f"{zoo_project.id}_{info_n}_{updated_at}.parquet")
+
+
+def evict_export_cache(cache_dir: str, cache_budget: int):
+    """
+    > This function removes the least recently used copies of the exports until the cache folder
+    fits in the disk budget. The last use of each copy is its access time
+
+    :param cache_dir: the folder with the local copies of the exports
+    :param cache_budget: the maximum size of the cache folder, in bytes
+    """
+    cached_files = sorted(
+        glob.glob(os.path.join(cache_dir, "*.parquet")), key=os.path.getatime
+    )
+    cache_size = sum(os.path.getsize(f) for f in cached_files)
+
+    while cached_files and cache_size > cache_budget:
+        oldest_file = cached_files.pop(0)
+        cache_size -= os.path.getsize(oldest_file)
+        os.remove(oldest_file)
+        logging.info(f"Removed {oldest_file} from the export cache")
+
+
+def read_cached_export(cache_path: str, info_n: str):
+    """
+    > This function reads the local copy of an export and records its use in the access time of
+    the file, leaving its modification (download) time untouched
+
+    :param cache_path: the path to the parquet file of the export
+    :param info_n: the type of export, e.g. "classifications"
+    :return: A dataframe with the export
+    """
+    logging.info(f"{info_n} retrieved from the local copy {cache_path}")
+    os.utime(cache_path, (time.time(), os.path.getmtime(cache_path)))
+    return pd.read_parquet(cache_path)
+
+
+def get_export_df(
+    zoo_project: Project,
+    info_n: str,
+    cache_dir: str = export_cache_dir,
+    max_age: float = None,
+    cache_budget: int = export_cache_budget,
+):
+    """
+    > This function returns an export from Zooniverse as a dataframe. The export is only
+    downloaded if there is no local copy of its latest version; the copies are kept as parquet
+    files and evicted (least recently used first) when the cache exceeds its disk budget
+
+    :param zoo_project: the Zooniverse project object
+    :param info_n: the type of export, e.g. "classifications"
+    :param cache_dir: the folder with the local copies of the exports, set to None to disable the cache
+    :param max_age: if the latest local copy was downloaded less than this number of seconds ago,
+    it is used without checking Zooniverse for a newer export
+    :param cache_budget: the maximum size of the cache folder, in bytes
+    :return: A dataframe with the export
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Use the latest local copy if it is recent enough
+        if max_age is not None:
+            cached_files = glob.glob(
+                os.path.join(cache_dir, f"{zoo_project.id}_{info_n}_*.parquet")
+            )
+            if cached_files:
+                latest_file = max(cached_files, key=os.path.getmtime)
+                if time.time() - os.path.getmtime(latest_file) < max_age:
+                    return read_cached_export(latest_file, info_n)
+
+        # Use the local copy of the latest version of the export if there is one
+        updated_at = zoo_project.describe_export(info_n)["media"][0]["updated_at"]
+        cache_path = get_export_cache_path(zoo_project, info_n, updated_at, cache_dir)
+        if os.path.exists(cache_path):
+            return read_cached_export(cache_path, info_n)
+
+    # Get the information of interest from Zooniverse
+    export = zoo_project.get_export(info_n)
+
+    # Save the info as pandas data frame
+    try:
+        export_df = pd.read_csv(io.StringIO(export.content.decode("utf-8")))
+    except pd.errors.ParserError:
+        logging.error("Export retrieval time out, please try again in 1 minute or so.")
+        raise
+
+    # Keep a local copy of the export
+    if cache_dir is not None and len(export_df) > 0:
+        try:
+            export_df.to_parquet(cache_path, index=False)
+            evict_export_cache(cache_dir, cache_budget)
+        except (ValueError, TypeError, OSError) as e:
+            logging.warning(f"The local copy of {info_n} could not be saved, {e}")
+
+    return export_df
+
+
+def stream_export(
+    zoo_project: Project, info_n: str, row_filter=None, chunk_size: int = 100000
+):
+    """
+    > This function parses an export from Zooniverse in chunks while it is being downloaded, so
+    the whole export is never held in memory. Only the rows selected by row_filter are yielded
+
+    :param zoo_project: the Zooniverse project object
+    :param info_n: the type of export, e.g. "classifications"
+    :param row_filter: a function that takes a chunk of the export and returns a boolean mask of
+    the rows to keep, defaults to keep all the rows
+    :param chunk_size: the number of rows parsed at a time
+    :return: A generator of dataframes
+    """
+    # Get the information of interest from Zooniverse without reading the whole body
+    export = zoo_project.get_export(info_n)
+    export.raw.decode_content = True
+
+    for chunk_df in pd.read_csv(export.raw, chunksize=chunk_size):
+        if row_filter is not None:
+            chunk_df = chunk_df[row_filter(chunk_df)]
+        if len(chunk_df) > 0:
+            yield chunk_df
+
+
+def workflow_filter(workflow_ids: list, workflow_versions: list):
+    """
+    > This function returns a row filter for stream_export that keeps the classifications made
+    with the workflows of interest, from their minimum version onwards
+
+    :param workflow_ids: the ids of the workflows of interest
+    :param workflow_versions: the minimum version of each workflow
+    :return: A function that takes a dataframe and returns a boolean mask
+    """
+
+    def row_filter(class_df: pd.DataFrame):
+        mask = pd.Series(False, index=class_df.index)
+        for workflow_id, version in zip(workflow_ids, workflow_versions):
+            mask |= (class_df.workflow_id == workflow_id) & (
+                class_df.workflow_version >= version
+            )
+        return mask
+
+    return row_filter
+
+
+def stream_classifications(
+    project: project_utils.Project,
+    zoo_project: Project,
+    workflow_ids: list,
+    workflow_versions: list,
+    chunk_size: int = 100000,
+):
+    """
+    > This function retrieves the classifications of the workflows of interest from Zooniverse,
+    parsing the export in chunks and dropping the rows of other workflows as it goes
+
+    :param project: the project object
+    :param zoo_project: the Zooniverse project object
+    :param workflow_ids: the ids of the workflows of interest
+    :param workflow_versions: the minimum version of each workflow
+    :param chunk_size: the number of rows parsed at a time
+    :return: A dataframe with the classifications of interest
+    """
+    logging.info("Retrieving classifications from Zooniverse")
+
+    classes = []
+    for class_df in stream_export(
+        zoo_project,
+        "classifications",
+        row_filter=workflow_filter(workflow_ids, workflow_versions),
+        chunk_size=chunk_size,
+    ):
+        # Combine classifications from duplicated subjects to unique subject id
+        if project.Project_name == "Koster_Seafloor_Obs":
+            class_df = combine_annot_from_duplicates(class_df, project)
+
+        # Ensure subject_ids match db format
+        class_df["subject_ids"] = class_df["subject_ids"].astype(np.int64)
+        classes.append(class_df)
+
+    if len(classes) == 0:
+        raise ValueError(
+            "There are no classifications for the workflows selected. This may be due to a "
+            "request time out, please try again in 1 minute."
+        )
+
+    logging.info("classifications retrieved successfully")
+
+    return pd.concat(classes, ignore_index=True)
+
+
 # Function to retrieve information from Zooniverse
 def retrieve_zoo_info(
-    project: project_utils.Project, zoo_project: Project, zoo_info: str
+    project: project_utils.Project,
+    zoo_project: Project,
+    zoo_info: str,
+    cache_dir: str = export_cache_dir,
+    max_age: float = None,
 ):
     """
     This function retrieves the information of interest from Zooniverse and saves it as a pandas data
@@ -76,6 +291,9 @@ def retrieve_zoo_info(
     :param zoo_project: the Zooniverse project object
     :param zoo_info: a list of the info you want to retrieve from Zooniverse
     :type zoo_info: str
+    :param cache_dir: the folder with the local copies of the exports, set to None to always download them
+    :param max_age: use the local copies younger than this number of seconds without checking
+    Zooniverse for newer exports
     :return: A dictionary of dataframes.
     """
     if hasattr(project, "info_df"):
@@ -90,14 +308,10 @@ def retrieve_zoo_info(
     for info_n in zoo_info:
         logging.info(f"Retrieving {info_n} from Zooniverse")
 
-        # Get the information of interest from Zooniverse
-        export = zoo_project.get_export(info_n)
-
-        # Save the info as pandas data frame
-        try:
-            export_df = pd.read_csv(io.StringIO(export.content.decode("utf-8")))
-        except pd.errors.ParserError:
-            logging.error("Export retrieval time out, please try again in 1 minute or so.")
+        # Get the information of interest from Zooniverse (or its local copy)
+        export_df = get_export_df(
+            zoo_project, info_n, cache_dir=cache_dir, max_age=max_age
+        )
 
         if len(export_df) > 0:
 
@@ -158,8 +372,71 @@ def extract_metadata(subj_df: pd.DataFrame):
     return subj_df, meta_df
 
 
+def get_subjects_delta(subjects: pd.DataFrame, db_path: str):
+    """
+    > This function selects the subjects of the Zooniverse export that are new or have changed
+    since the last sync of the database. Subjects above the high-water mark (the latest created_at
+    and id in the subjects table) are new, the rest are compared with the fields that Zooniverse
+    updates after the upload (classifications count and retirement info)
+
+    :param subjects: the subjects dataframe from the Zooniverse export
+    :param db_path: the path to the database
+    :return: A dataframe with the subjects that have to be added or updated in the database
+    """
+
+    # Create connection to db
+    conn = db_utils.get_connection(db_path, read_only=True)
+
+    # Query the subjects already in the db
+    db_subjects = pd.read_sql_query(
+        "SELECT id, created_at, classifications_count, retired_at, retirement_reason FROM subjects",
+        conn,
+    )
+
+    if db_subjects.empty:
+        return subjects
+
+    # Get the high-water mark of the subjects in the db
+    max_id = db_subjects["id"].max()
+    max_created_at = db_subjects["created_at"].max()
+
+    subject_ids = subjects["subject_id"].astype(np.int64)
+    new_subjects = (subject_ids > max_id) | (subjects["created_at"] > max_created_at)
+
+    # Compare the rest of the subjects with their version in the db
+    below_mark = subjects[~new_subjects].assign(id=subject_ids[~new_subjects])
+    below_mark = pd.merge(
+        below_mark[["id", "classifications_count", "retired_at", "retirement_reason"]],
+        db_subjects,
+        how="left",
+        on="id",
+        suffixes=("", "_db"),
+        indicator=True,
+    )
+    changed = (below_mark["_merge"] == "left_only") | (
+        pd.to_numeric(below_mark["classifications_count"])
+        != pd.to_numeric(below_mark["classifications_count_db"])
+    )
+    for col in ["retired_at", "retirement_reason"]:
+        changed |= below_mark[col].fillna("").astype(str) != below_mark[
+            f"{col}_db"
+        ].fillna("").astype(str)
+    changed_ids = below_mark.loc[changed.values, "id"].unique()
+
+    subjects = subjects[new_subjects | subject_ids.isin(changed_ids)]
+
+    logging.info(
+        f"{subjects['subject_id'].nunique()} subjects are new or have changed since the last sync"
+    )
+
+    return subjects
+
+
 def populate_subjects(
-    subjects: pd.DataFrame, project: project_utils.Project, db_path: str
+    subjects: pd.DataFrame,
+    project: project_utils.Project,
+    db_path: str,
+    incremental: bool = False,
 ):
     """
     Populate the subjects table with the subject metadata
@@ -168,12 +445,20 @@ def populate_subjects(
     :param project_path: The path to the projects.csv file
     :param project_name: The name of the Zooniverse project
     :param db_path: the path to the database
+    :param incremental: only upsert the subjects that are new or changed since the last sync
     """
 
     project_name = project.Project_name
     server = project.server
     movie_folder = project.movie_folder
 
+    # Select the subjects that are new or have changed since the last sync
+    if incremental:
+        subjects = get_subjects_delta(subjects, db_path)
+        if subjects.empty:
+            logging.info("The subjects table is already up to date")
+            return
+
     # Check if the Zooniverse project is the KSO
     if project_name == "Koster_Seafloor_Obs":
            
@@ -261,12 +546,26 @@ def populate_subjects(
     # Test table validity
     db_utils.test_table(subjects, "subjects", keys=["id"])
 
-    # Add values to subjects
-    db_utils.add_to_table(db_path, "subjects", [tuple(i) for i in subjects.values], 15)
+    # Add values to subjects in a single bulk-load transaction
+    conn = db_utils.begin_bulk_load(db_path, defer_indexes=not incremental)
+    try:
+        db_utils.add_to_table(
+            db_path,
+            "subjects",
+            [tuple(i) for i in subjects.values],
+            15,
+            conn=conn,
+            upsert=incremental,
+        )
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_utils.end_bulk_load(conn)
 
     ##### Print how many subjects are in the db
     # Create connection to db
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     # Query id and subject type from the subjects table
     subjects_df = pd.read_sql_query("SELECT id, subject_type FROM subjects", conn)
@@ -298,7 +597,7 @@ def populate_agg_annotations(
     # Get the project-specific name of the database
     db_path = project.db_path
 
-    conn = db_utils.create_connection(db_path)
+    conn = db_utils.get_connection(db_path, read_only=True)
 
     # Query id and subject type from the subjects table
     subjects_df = pd.read_sql_query("SELECT id, frame_exp_sp_id FROM subjects", conn)